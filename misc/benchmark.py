@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: ascii -*-
+
+import os, re, time
+import json
+import threading
+import shutil
+import tempfile
+import tracemalloc
+import optparse
+
+import tellbot
+
+# Each benchmark is a function taking the parsed options and returning a
+# list of (label, seconds, operations) tuples; main() prints them.
+
+BENCHMARKS = {}
+
+def benchmark(func):
+    BENCHMARKS[func.__name__[6:]] = func
+    return func
+
+def measure(func, count):
+    start = time.perf_counter()
+    func(count)
+    return time.perf_counter() - start
+
+@benchmark
+def bench_nicks(options):
+    # A small population of nicks normalized over and over again.
+    nicks = ['Some User %s' % (i % 300) for i in range(options.count)]
+    def uncached(count):
+        for n in nicks[:count]:
+            (tellbot.basebot.normalize_nick(n), re.sub(r'\s+', '', n))
+    def cached(count):
+        for n in nicks[:count]:
+            (tellbot.normalize_nick(n), tellbot.seminormalize_nick(n))
+    ret = [('uncached', measure(uncached, options.count), options.count),
+           ('cached', measure(cached, options.count), options.count)]
+    for name, info in sorted(tellbot.nick_cache_info().items()):
+        print('%s cache: %s hits, %s misses' % (name, info.hits,
+                                                info.misses))
+    return ret
+
+@benchmark
+def bench_groups(options):
+    # Group arithmetic as in "!tell *big -*alsobig"; entries are
+    # (user, nick) pairs keyed by the first element.
+    size = max(options.count // 10, 1)
+    big = [('user%s' % i, 'User %s' % i) for i in range(size)]
+    other = big[::2]
+    def union(count):
+        for _ in range(count):
+            s = tellbot.OrderedSet.firstel(big)
+            s.update(other)
+    def difference(count):
+        for _ in range(count):
+            s = tellbot.OrderedSet.firstel(big)
+            s.difference_update(other)
+    def intersection(count):
+        for _ in range(count):
+            tellbot.OrderedSet.firstel(big).intersection(other)
+    return [('union', measure(union, 10), 10 * size),
+            ('difference', measure(difference, 10), 10 * size),
+            ('intersection', measure(intersection, 10), 10 * size)]
+
+def memory_dataset(count):
+    # Messages among a few hundred users in a few rooms; every record is
+    # decoded separately, as it would be when arriving from the network.
+    for i in range(count):
+        user, sender = 'user%s' % (i % 300), 'user%s' % (i * 7 % 300)
+        yield json.loads(json.dumps({'from': sender.title(), 'to': user,
+            'tonick': user.title(), 'reason': '*group%s' % (i % 30),
+            'text': 'message %s' % i, 'timestamp': time.time(),
+            'priority': 'NORMAL', 'room': 'room%s' % (i % 20)}))
+
+@benchmark
+def bench_memory(options):
+    # Heap usage of the memory distributor with and without interning.
+    count, ret = max(options.count // 5, 1), []
+    for intern in (False, True):
+        distr = tellbot.NotificationDistributorMemory()
+        distr.INTERN = intern
+        def fill(count):
+            for m in memory_dataset(count):
+                distr.add_message(m['to'], m)
+                distr.update_seen(m['to'], m['tonick'], m['timestamp'], 1,
+                                  m['room'])
+        tracemalloc.start()
+        secs = measure(fill, count)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        label = 'interned' if intern else 'plain'
+        print('%s: %.1f MiB' % (label, size / 1048576.0))
+        ret.append((label, secs, count))
+    return ret
+
+def chat_workload(distr, count, prefix='user'):
+    # Roughly what a busy room does: messages being sent, and recipients
+    # speaking up and reading them.
+    for i in range(count):
+        user = '%s%s' % (prefix, i % 100)
+        distr.add_message(user, {'from': 'sender', 'reason': '@' + user,
+            'text': 'message %s' % i, 'timestamp': time.time(),
+            'priority': 'NORMAL', 'room': 'test'})
+        distr.message_bounds(user)
+        distr.update_seen(user, user, time.time(), 1, 'test')
+        if i % 10 == 0: distr.pop_messages(user)
+
+@benchmark
+def bench_profiles(options):
+    count = max(options.count // 50, 1)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        ret = []
+        for name in sorted(tellbot.SQLITE_PROFILES):
+            path = os.path.join(tmpdir, name + '.sqlite')
+            distr = tellbot.NotificationDistributorSQLite(path,
+                                                          profile=name)
+            ret.append((name, measure(lambda c: chat_workload(distr, c),
+                                      count), count))
+            distr.conn.close()
+        return ret
+    finally:
+        shutil.rmtree(tmpdir)
+
+@benchmark
+def bench_threads(options):
+    # The chat workload run by several threads on disjoint users, against
+    # a memory distributor with a single lock stripe and with the default.
+    count = max(options.count // 20, 1)
+    ret = []
+    for stripes in (1, tellbot.LOCK_STRIPES):
+        for threads in (1, 4):
+            distr = tellbot.NotificationDistributorMemory(stripes)
+            def run(count):
+                workers = [threading.Thread(target=chat_workload,
+                    args=(distr, count // threads, 't%s-' % i))
+                    for i in range(threads)]
+                for w in workers: w.start()
+                for w in workers: w.join()
+            ret.append(('%s stripes, %s threads' % (stripes, threads),
+                        measure(run, count), count))
+    return ret
+
+@benchmark
+def bench_backends(options):
+    # The chat workload plus the lookups commands do, against each kind of
+    # local distributor.
+    count = max(options.count // 50, 1)
+    tmpdir = tempfile.mkdtemp()
+    def workload(distr, count):
+        distr.update_group('group', [('user%s' % i, 'User %s' % i)
+                                     for i in range(100)])
+        chat_workload(distr, count)
+        for i in range(count):
+            distr.query_user('User %s' % (i % 100))
+            distr.query_group('group')
+            distr.query_groups_of('user%s' % (i % 100))
+    try:
+        path = os.path.join(tmpdir, 'test.sqlite')
+        backends = (
+            ('memory', tellbot.NotificationDistributorMemory),
+            ('sqlite', lambda: tellbot.NotificationDistributorSQLite(path)),
+            ('cached', lambda: tellbot.NotificationDistributorCached(path)))
+        ret = []
+        for name, factory in backends:
+            distr = factory()
+            ret.append((name, measure(lambda c: workload(distr, c), count),
+                        count))
+        return ret
+    finally:
+        shutil.rmtree(tmpdir)
+
+@benchmark
+def bench_startup(options):
+    # Opening an existing database is what restarts mostly do.
+    count = max(options.count // 1000, 1)
+    defaults = (tellbot.TellBot.DEFAULT_SETTINGS +
+                tellbot.Mailer.DEFAULT_SETTINGS)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = [os.path.join(tmpdir, '%s.sqlite' % i) for i in range(count)]
+        def start(count):
+            for path in paths[:count]:
+                distr = tellbot.NotificationDistributorSQLite(path)
+                distr.init_settings(defaults)
+                distr.conn.close()
+        return [('fresh', measure(start, count), count),
+                ('existing', measure(start, count), count)]
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-h|--help] [--count=n] '
+            '[benchmark ...]',
+        description='Run @TellBot microbenchmarks.',
+        epilog='Available benchmarks: %s (default all).' %
+            ', '.join(sorted(BENCHMARKS)))
+    parser.add_option('--count', type='int', dest='count', default=100000,
+                      metavar='n', help='workload size (default %default)')
+    options, args = parser.parse_args()
+    for name in args:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %r' % name)
+    for name in (args or sorted(BENCHMARKS)):
+        print('== %s' % name)
+        for label, secs, ops in BENCHMARKS[name](options):
+            print('%-24s %10.3f s %12.1f ops/s' % (label, secs,
+                                                   ops / secs if secs else 0))
+
+if __name__ == '__main__': main()
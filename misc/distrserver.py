@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: ascii -*-
+
+import optparse
+
+import tellbot
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-h|--help] [--db=path] '
+            '[--cache] [--archive=path] [--config=key=value ...] [--public] '
+            'address',
+        description='Serve a @TellBot message store to multiple @TellBot '
+            'instances (which are started with --remote=address).',
+        epilog='address is either [unix:]PATH or tcp:HOST:PORT. There is '
+            'no authentication: Unix sockets are protected by their '
+            'permissions, and TCP addresses must be loopback ones unless '
+            '--public is given. Without --db, messages are kept in memory '
+            'and lost when the server exits.')
+    parser.add_option('--db', dest='db', metavar='path',
+                      help='SQLite database file to serve')
+    parser.add_option('--cache', dest='cache', action='store_true',
+                      help='keep the database contents in memory (with '
+                          '--db)')
+    parser.add_option('--archive', dest='archive', metavar='path',
+                      help='SQLite database file to move delivered messages '
+                          'into (with --db)')
+    parser.add_option('--config', dest='confopts', action='append',
+                      metavar='key=value', default=[],
+                      help='a setting to apply before starting (clients '
+                          'cannot change settings)')
+    parser.add_option('--public', dest='public', action='store_true',
+                      help='allow listening on non-loopback TCP addresses')
+    options, args = parser.parse_args()
+    if len(args) < 1:
+        parser.error('missing address')
+    elif len(args) > 1:
+        parser.error('excess command line arguments')
+    if options.cache and not options.db:
+        parser.error('--cache requires --db')
+    if options.archive and not options.db:
+        parser.error('--archive requires --db')
+    threads = []
+    if options.db and options.cache:
+        distr = tellbot.NotificationDistributorCached(options.db,
+                                                      archive=options.archive)
+        threads.append(tellbot.SeenFlushThread(distr))
+    elif options.db:
+        distr = tellbot.NotificationDistributorSQLite(options.db,
+                                                      archive=options.archive)
+    else:
+        distr = tellbot.NotificationDistributorMemory()
+    distr.init_settings(tellbot.TellBot.DEFAULT_SETTINGS +
+                        tellbot.Mailer.DEFAULT_SETTINGS)
+    for el in options.confopts:
+        name, sep, value = el.partition('=')
+        if not sep: parser.error('bad configuration value: %r' % el)
+        distr.set_setting(name, value)
+    try:
+        server = tellbot.NotificationDistributorServer.create(args[0], distr,
+                                                              options.public)
+    except ValueError as exc:
+        parser.error(str(exc))
+    threads.append(tellbot.GCThread(distr))
+    # Clients leave scheduled maintenance and backups to the server.
+    threads.append(tellbot.MaintenanceThread(distr))
+    threads.append(tellbot.BackupThread(distr))
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for t in threads: t.shutdown()
+        server.server_close()
+
+if __name__ == '__main__': main()
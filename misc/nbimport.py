@@ -61,7 +61,7 @@ def import_groups(f, distr):
             if not members: continue
             old_members = distr.query_group(name)
             entries = tellbot.OrderedSet.firstel(old_members)
-            entries.extend(distr.normalize_user(m) for m in members)
+            entries.update(distr.normalize_user(m) for m in members)
             distr.update_group(name, list(entries))
 
 def main():
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: ascii -*-
+
+import os, sys, time
+import socket
+import threading
+import shutil
+import tempfile
+import traceback
+import optparse
+
+import tellbot
+
+# Each check is a function taking the parsed options and raising an
+# exception (usually an AssertionError) if something is amiss; main() runs
+# them and reports the outcome. Everything runs on the local host.
+
+CHECKS = {}
+
+def check(func):
+    CHECKS[func.__name__[6:]] = func
+    return func
+
+def serve(distr, address):
+    server = tellbot.NotificationDistributorServer.create(address, distr)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def remote_session(address):
+    # Batching, locking, and recovering from a lost connection.
+    distr = tellbot.NotificationDistributorRemote(address)
+    distr.add_message('user', {'from': 'Sender', 'reason': '@User',
+                               'text': 'hello', 'timestamp': time.time()})
+    res = distr.call_many([('message_bounds', 'user'),
+                           ('query_messages', 'user')])
+    assert res[0][0] == 1 and res[1][0]['text'] == 'hello', res
+    other, order = tellbot.NotificationDistributorRemote(address), []
+    def contender():
+        with other: order.append('other')
+    with distr:
+        t = threading.Thread(target=contender)
+        t.start()
+        time.sleep(0.2)
+        order.append('self')
+    t.join()
+    assert order == ['self', 'other'], order
+    distr.local.conn[0].shutdown(socket.SHUT_RDWR)
+    try:
+        distr.message_bounds('user')
+    except tellbot.DistributorError:
+        pass
+    else:
+        raise AssertionError('call on closed connection succeeded')
+    assert distr.message_bounds('user')[0] == 1
+
+@check
+def check_remote(options):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for address in ('unix:' + os.path.join(tmpdir, 'socket'),
+                        'tcp:127.0.0.1:0'):
+            server = serve(tellbot.NotificationDistributorMemory(), address)
+            try:
+                if address.startswith('tcp:'):
+                    address = 'tcp:%s:%s' % server.server_address
+                remote_session(address)
+            finally:
+                server.shutdown()
+                server.server_close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+@check
+def check_claims(options):
+    # Two processes sharing a database never deliver the same message.
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'tellbot.sqlite')
+        first = tellbot.NotificationDistributorSQLite(path, shared=True)
+        second = tellbot.NotificationDistributorSQLite(path, shared=True)
+        msg = {'from': 'Sender', 'text': 'hello', 'reason': '@User',
+               'timestamp': time.time()}
+        first.add_message('user', msg)
+        assert first.claim_delivery(msg['id'], 60)
+        assert not second.claim_delivery(msg['id'], 60)
+        assert not first.claim_delivery(msg['id'], 60)
+        first.add_delivery(msg, 'msgid', time.time())
+        assert second.claim_delivery(msg['id'], 0)
+        assert first.claim_delivery(msg['id'], 60)
+        first.conn.close()
+        second.conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+@check
+def check_cache(options):
+    # The cache agrees with a database from before the unread column.
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'tellbot.sqlite')
+        distr = tellbot.NotificationDistributorSQLite(path)
+        distr.update_seen('user', 'User', time.time(), 0, 'test')
+        distr.curs.execute('UPDATE seen SET unread = NULL')
+        distr.conn.commit()
+        distr.conn.close()
+        distr = tellbot.NotificationDistributorCached(path)
+        res = distr.check()
+        assert not res, res
+        distr.db.conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+class StatusBot:
+    # Just enough of a TellBot to run !tstatus.
+    nickname = 'TellBot'
+    _format_nick = tellbot.TellBot._format_nick
+    _format_reason = tellbot.TellBot._format_reason
+    list_sent = tellbot.TellBot.list_sent
+
+    class manager:
+        inbox_lock = threading.Lock()
+        status_cursors = {}
+
+@check
+def check_status(options):
+    # !tstatus output for replies to a group and to a single user.
+    distr, now = tellbot.NotificationDistributorMemory(), time.time()
+    for user in ('alice', 'bob', 'carol'):
+        distr.add_message(user, {'from': 'Dave', 'to': user,
+            'tonick': user.title(), 'reason': '<re> *group',
+            'text': 'reply to all', 'timestamp': now - 60})
+    distr.add_message('alice', {'from': 'Dave', 'tonick': 'Alice',
+        'reason': '<re> @Alice', 'text': 'reply', 'timestamp': now})
+    distr.pop_messages('bob')
+    lines = []
+    StatusBot().list_sent(distr, ('dave', 'Dave'), lines.append)
+    lines = lines[0].split('\n')
+    assert lines[0].startswith('[replying to Alice, '), lines
+    assert lines[0].endswith('] pending: reply'), lines
+    assert lines[1].startswith('[replying to *group, '), lines
+    assert lines[1].endswith('] delivered to Bob; pending for Carol, '
+                             'Alice: reply to all'), lines
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-h|--help] [check ...]',
+        description='Run @TellBot self-checks.',
+        epilog='Available checks: %s (default all).' %
+            ', '.join(sorted(CHECKS)))
+    options, args = parser.parse_args()
+    for name in args:
+        if name not in CHECKS:
+            parser.error('unknown check %r' % name)
+    failed = 0
+    for name in (args or sorted(CHECKS)):
+        try:
+            CHECKS[name](options)
+        except Exception:
+            failed += 1
+            print('FAIL %s' % name)
+            traceback.print_exc()
+        else:
+            print('ok   %s' % name)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__': main()
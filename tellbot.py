@@ -2,28 +2,65 @@
 # -*- coding: ascii -*-
 
 import sys, os, re, time
-import operator, collections
+import asyncio
+import concurrent.futures
+import operator, collections, functools, itertools, contextlib
+import bisect, heapq
 import base64
-import fnmatch
+import logging
 import threading
-import subprocess
 import sqlite3
 
-from xml.sax.saxutils import escape
-
-try:
-    from queue import Queue
-except ImportError:
-    from Queue import Queue
-
 import basebot
 
 INBOX_CUTOFF = 172800 # 2 days
 REPLY_TIMEOUT = 172800 # 2 days
+STALE_TIMEOUT = 172800 # 2 days
+DELIVERY_MAP_SIZE = 100000 # entries
 GC_INTERVAL = 3600 # 1 hour
+ARCHIVE_DELAY = 3600 # 1 hour
+ARCHIVE_RETENTION = 2592000 # 30 days
+ARCHIVE_BATCH_SIZE = 500 # messages moved per transaction
+MAINTENANCE_INTERVAL = 86400 # 1 day
+MAINTENANCE_PAGES = 256 # pages freed per step
+BACKUP_INTERVAL = 86400 # 1 day
+BACKUP_PAGES = 64 # pages copied per step
+BACKUP_PAUSE = 0.01 # 10 msecs
+BACKUP_KEEP = 7 # snapshots
 NOTBOT_DELAY = 10 # 10 secs
+INBOX_PAGE_SIZE = 20 # messages fetched at once
+STATUS_PAGE_SIZE = 10 # messages listed by !tstatus at once
+STATUS_TEXT_LENGTH = 40 # characters of message text listed by !tstatus
+STATUS_FETCH_SIZE = 100 # messages fetched at once by !tstatus
+STATUS_NICK_COUNT = 5 # recipients named per !tstatus entry
+DELIVERY_TIMEOUT = 60 # 1 min
+SHARED_DB_TIMEOUT = 30 # 30 secs
+REMOTE_LOCK_TIMEOUT = 30 # 30 secs
+RECIPIENT_LIST_LIMIT = 2000 # characters
+SQL_BATCH_SIZE = 500 # users looked up per statement
+NICK_CACHE_SIZE = 4096 # entries
+LOCK_STRIPES = 16 # memory distributor inbox locks
 MAIL_SEEN_COOLOFF = 604800 # 1 week
 MAIL_SEND_COOLOFF = 604800 # 1 week
+DIGEST_INTERVAL = 60 # 1 min
+DIGEST_MAX_MESSAGES = 50 # messages listed in a digest
+SEEN_FLUSH_INTERVAL = 5 # 5 secs
+
+# SQLite tuning presets; see NotificationDistributorSQLite.apply_profile().
+# "durable" matches SQLite's defaults.
+SQLITE_PROFILES = {
+    'durable': {'journal_mode': 'DELETE', 'synchronous': 'FULL',
+                'cache_size': -2000, 'mmap_size': 0, 'temp_store': 'DEFAULT'},
+    'balanced': {'journal_mode': 'WAL', 'synchronous': 'NORMAL',
+                 'cache_size': -16000, 'mmap_size': 67108864,
+                 'temp_store': 'MEMORY'},
+    'fast': {'journal_mode': 'WAL', 'synchronous': 'OFF',
+             'cache_size': -65536, 'mmap_size': 268435456,
+             'temp_store': 'MEMORY'}
+}
+DEFAULT_SQLITE_PROFILE = 'durable'
+# Bump whenever NotificationDistributorSQLite.init() changes the schema.
+SCHEMA_VERSION = 5
 
 HELP_TEXT = '''
 To add a message to other users' mailbox, use
@@ -86,16 +123,73 @@ total).</p>
 --%(boundary)s--
 '''[1:]
 
+EMAIL_DIGEST_TEMPLATE = '''
+From: %(from)s
+To: %(to)s
+Subject: %(subject)s
+MIME-Version: 1.0
+Content-Type: multipart/alternative; boundary="%(boundary)s"
+
+This is a multi-part MIME message.
+
+--%(boundary)s
+Content-Type: text/plain; charset=utf-8
+
+You have %(unread_total)s unread TellBot messages (the oldest one is from \
+%(plain_oldest)s).
+%(plain_messages)s%(plain_more)s
+Reply to this email to unsubscribe.
+
+--%(boundary)s
+Content-Type: text/html; charset=utf-8
+
+<!DOCTYPE html>
+<html>
+  <body>
+    <p>You have %(unread_total)s unread TellBot messages (the oldest one \
+is from %(html_oldest)s).</p>
+    <p><table border=0 cellpadding=2 cellspacing=0>
+      <tr><th align=left>From</th><th align=left>To</th>\
+<th align=left>Priority</th><th align=left>Text</th></tr>
+%(html_messages)s
+    </table></p>
+    %(html_more)s
+    <p><small>Reply to this email to unsubscribe.</small></p>
+  </body>
+</html>
+
+--%(boundary)s--
+'''[1:]
+
 def is_true(s):
     if isinstance(s, str):
         return s.lower() in ('yes', 'true', 'on', 'y', '1')
     else:
         return bool(s)
 
+# Nicknames are normalized over and over again (on every chat line and for
+# every recipient of a message), so the results are cached.
+WHITESPACE_RE = re.compile(r'\s+')
+
+@functools.lru_cache(maxsize=NICK_CACHE_SIZE)
+def normalize_nick(nick):
+    return basebot.normalize_nick(nick)
+@functools.lru_cache(maxsize=NICK_CACHE_SIZE)
 def seminormalize_nick(nick):
-    return re.sub(r'\s+', '', nick)
+    return WHITESPACE_RE.sub('', nick)
 def make_mention(nick):
-    return '@' + re.sub(r'\s+', '', nick)
+    return '@' + seminormalize_nick(nick)
+
+def nick_cache_info():
+    return {'normalize': normalize_nick.cache_info(),
+            'seminormalize': seminormalize_nick.cache_info()}
+
+def asciienc(s):
+    return s.encode('ascii').decode('ascii')
+def htmlenc(s):
+    from xml.sax.saxutils import escape
+    return escape(s).encode('ascii',
+        errors='xmlcharrefreplace').decode('ascii')
 
 def titlefirst(s):
     if not s: return ''
@@ -125,59 +219,68 @@ class OrderedSet:
         return cls(base, operator.itemgetter(0))
 
     def __init__(self, base=(), key=lambda x: x):
-        self.list = []
-        self.set = set()
+        # Maps keys to items; dicts preserve insertion order.
+        self.items = {}
         self.key = key
-        self.extend(base)
+        self.update(base)
 
     def __bool__(self):
-        return bool(self.list)
+        return bool(self.items)
     def __nonzero__(self):
-        return bool(self.list)
+        return bool(self.items)
 
     def __len__(self):
-        return len(self.list)
+        return len(self.items)
 
     def __contains__(self, item):
-        return self.key(item) in self.set
+        return self.key(item) in self.items
 
     def __iter__(self):
-        return iter(self.list)
+        return iter(self.items.values())
 
     def __eq__(self, other):
         if not isinstance(other, OrderedSet): return NotImplemented
-        return self.set == other.set
+        return self.items.keys() == other.items.keys()
 
     def copy(self):
-        return self.__class__(self, key=self.key)
+        ret = self.__class__(key=self.key)
+        ret.items = self.items.copy()
+        return ret
 
     def clear(self):
-        self.list[:] = ()
-        self.set.clear()
+        self.items.clear()
 
     def append(self, item):
-        key = self.key(item)
-        if key not in self.set:
-            self.set.add(key)
-            self.list.append(item)
+        self.items.setdefault(self.key(item), item)
 
-    def extend(self, items):
+    def update(self, items):
+        key, setdefault = self.key, self.items.setdefault
         for item in items:
-            self.append(item)
+            setdefault(key(item), item)
 
     def discard(self, item):
-        key = self.key(item)
-        if key in self.set:
-            self.set.remove(key)
-            self.list[:] = [i for i in self.list if self.key(i) != key]
+        self.items.pop(self.key(item), None)
 
-    def discard_all(self, items):
+    def difference_update(self, items):
+        key, pop = self.key, self.items.pop
         for item in items:
-            self.discard(item)
+            pop(key(item), None)
+
+    def intersection(self, items):
+        key = self.key
+        keep = set(key(item) for item in items)
+        ret = self.__class__(key=key)
+        ret.items = dict((k, v) for k, v in self.items.items() if k in keep)
+        return ret
+
+    # Backwards-compatible names.
+    extend = update
+    discard_all = difference_update
 
     def sort(self, key=None, reverse=False):
         if key is None: key = self.key
-        self.list.sort(key=key, reverse=reverse)
+        items = sorted(self.items.values(), key=key, reverse=reverse)
+        self.items = dict((self.key(item), item) for item in items)
 
 class DBLock:
     class Committer:
@@ -196,6 +299,15 @@ class DBLock:
         self.commit = False
         self.counter = 0
         self.committing = self.Committer(self)
+        # Group commit: If group_delay is not None, committers wait up to
+        # that many seconds for others to join them in a single commit.
+        self.group_delay = None
+        self.cond = threading.Condition(threading.Lock())
+        self.requested = 0
+        self.committed = 0
+        self.leader = False
+        self.stats = {'commits': 0, 'writes': 0, 'max_batch': 0,
+                      'latency': 0.0}
 
     def __enter__(self):
         self.acquire()
@@ -213,18 +325,66 @@ class DBLock:
         if not self.lock._is_owned():
             raise RuntimeError('Trying to release foreign lock!')
         self.counter -= 1
+        target = None
         if self.counter == 0 and self.commit:
-            if self.conn: self.conn.commit()
             self.commit = False
-        return self.lock.release()
+            if self.group_delay is None:
+                if self.conn: self.conn.commit()
+            else:
+                with self.cond:
+                    self.requested += 1
+                    target = self.requested
+        ret = self.lock.release()
+        # Only return once the changes are durable.
+        if target is not None: self._wait_commit(target)
+        return ret
+
+    def _wait_commit(self, target):
+        start = time.time()
+        with self.cond:
+            while self.committed < target:
+                if not self.leader:
+                    self.leader = True
+                    break
+                self.cond.wait()
+            else:
+                self.stats['latency'] += time.time() - start
+                return
+        # We are the leader; give others a chance to join the batch.
+        time.sleep(self.group_delay)
+        upto = None
+        try:
+            with self.lock:
+                with self.cond:
+                    pending = self.requested
+                if self.conn: self.conn.commit()
+                upto = pending
+        finally:
+            with self.cond:
+                if upto is not None:
+                    batch = upto - self.committed
+                    self.committed = upto
+                    self.stats['commits'] += 1
+                    self.stats['writes'] += batch
+                    self.stats['max_batch'] = max(self.stats['max_batch'],
+                                                  batch)
+                    self.stats['latency'] += time.time() - start
+                self.leader = False
+                self.cond.notify_all()
 
 class NotificationDistributor:
+    # Whether settings listeners hear about changes made by other
+    # processes, too (so that settings can be cached).
+    NOTIFIES_SETTINGS = True
+
+    def __init__(self):
+        self.settings_listeners = []
     def __enter__(self):
         raise NotImplementedError
     def __exit__(self, t, v, tb):
         raise NotImplementedError
     def normalize_user(self, name):
-        return (basebot.normalize_nick(name), seminormalize_nick(name))
+        return (normalize_nick(name), seminormalize_nick(name))
     def query_user(self, name):
         raise NotImplementedError
     def query_aliases(self, base):
@@ -233,12 +393,16 @@ class NotificationDistributor:
         raise NotImplementedError
     def query_seen(self, user):
         raise NotImplementedError
+    def query_seen_many(self, users):
+        return [self.query_seen(u) for u in users]
     def update_seen(self, user, name, time, unread, room):
         raise NotImplementedError
     def list_groups(self):
         raise NotImplementedError
     def query_groups_of(self, user):
         raise NotImplementedError
+    def query_groups_of_many(self, users):
+        return [self.query_groups_of(u) for u in users]
     def query_group(self, name, raw=False):
         raise NotImplementedError
     def update_group(self, name, members):
@@ -249,14 +413,23 @@ class NotificationDistributor:
         raise NotImplementedError
     def message_bounds(self, user):
         raise NotImplementedError
+    def message_bounds_many(self, users):
+        return [self.message_bounds(u) for u in users]
     def query_messages(self, user, stale=False):
         raise NotImplementedError
+    def query_message_page(self, user, cursor=None, limit=INBOX_PAGE_SIZE,
+                           stale=False):
+        raise NotImplementedError
     def pop_messages(self, user, stale=False):
         raise NotImplementedError
+    def query_sent_page(self, user, cursor=None, limit=STATUS_PAGE_SIZE):
+        raise NotImplementedError
     def add_message(self, user, message):
         raise NotImplementedError
     def query_delivery(self, msgid):
         raise NotImplementedError
+    def claim_delivery(self, msgid, timeout):
+        raise NotImplementedError
     def add_delivery(self, msg, msgid, timestamp):
         raise NotImplementedError
     def get_mail_info(self, user):
@@ -265,212 +438,551 @@ class NotificationDistributor:
         raise NotImplementedError
     def update_mail_throttle(self, user, throttle):
         raise NotImplementedError
+    def get_mail_digest(self, user):
+        raise NotImplementedError
+    def update_mail_digest(self, user, window):
+        raise NotImplementedError
+    def schedule_mail_digest(self, user, due):
+        raise NotImplementedError
+    def pop_mail_digests(self, now):
+        raise NotImplementedError
     def init_setting(self, key, value):
         raise NotImplementedError
+    def init_settings(self, items):
+        for key, value in items: self.init_setting(key, value)
     def get_setting(self, key):
         raise NotImplementedError
     def set_setting(self, key, value):
         raise NotImplementedError
+    def maintain(self, full=False):
+        raise NotImplementedError
+    def subscribe_settings(self, callback):
+        self.settings_listeners.append(callback)
+    def _settings_changed(self, key):
+        # key is None if any setting might have changed.
+        for cb in tuple(self.settings_listeners): cb(key)
+    def archive(self):
+        return 0
+    def backup(self):
+        return None
     def gc(self):
         raise NotImplementedError
 
+class SortedInbox:
+    # The messages to one recipient ordered by (timestamp, id), along with
+    # the (likewise ordered) subset of them that is not delivered yet. The
+    # sort keys are kept in parallel lists for bisect. Without
+    # track_pending, only the former list is maintained (for outboxes).
+    KEY = operator.itemgetter('timestamp', 'id')
+
+    @classmethod
+    def merge(cls, lists):
+        if not lists: return []
+        if len(lists) == 1: return list(lists[0])
+        return list(heapq.merge(*lists, key=cls.KEY))
+
+    def __init__(self, track_pending=True):
+        self.track_pending = track_pending
+        self.keys, self.messages = [], []
+        self.pkeys, self.pending = [], []
+
+    def __len__(self):
+        return len(self.messages)
+
+    def _insert(self, keys, msgs, key, msg):
+        i = bisect.bisect_right(keys, key)
+        keys.insert(i, key)
+        msgs.insert(i, msg)
+
+    def add(self, msg):
+        key = self.KEY(msg)
+        self._insert(self.keys, self.messages, key, msg)
+        if self.track_pending and msg.get('delivered') is None:
+            self._insert(self.pkeys, self.pending, key, msg)
+
+    def mark_delivered(self, msg):
+        key = self.KEY(msg)
+        i = bisect.bisect_left(self.pkeys, key)
+        if i < len(self.pkeys) and self.pkeys[i] == key:
+            del self.pkeys[i]
+            del self.pending[i]
+
+    def bounds(self):
+        if not self.pending: return (0, None, None)
+        return (len(self.pending), self.pending[0]['timestamp'],
+                self.pending[-1]['timestamp'])
+
+    def select(self, stale=False, cursor=None):
+        keys, msgs = ((self.keys, self.messages) if stale else
+                      (self.pkeys, self.pending))
+        if cursor is None: return msgs
+        return msgs[bisect.bisect_right(keys, tuple(cursor)):]
+
+    def before(self, cursor=None, limit=None):
+        # Up to limit messages preceding cursor, newest first.
+        end = (len(self.messages) if cursor is None else
+               bisect.bisect_left(self.keys, tuple(cursor)))
+        start = 0 if limit is None else max(end - limit, 0)
+        return self.messages[start:end][::-1]
+
+    def collect(self, deadline):
+        # Drop messages delivered before deadline; return them.
+        keep, drop = [], []
+        for m in self.messages:
+            if m.get('delivered') is not None and m['delivered'] < deadline:
+                drop.append(m)
+            else:
+                keep.append(m)
+        if drop:
+            self.messages = keep
+            self.keys = [self.KEY(m) for m in keep]
+        return drop
+
+class CatalogSnapshot:
+    # An immutable view of the alias and group tables. Writers build a new
+    # snapshot and swap the reference, so readers need not take any lock.
+    # Missing reverse mappings are derived from the forward ones.
+    def __init__(self, aliases=None, groups=None, groupdescs=None,
+                 revaliases=None, revgroups=None):
+        self.aliases = aliases or {}
+        self.groups = groups or {}
+        self.groupdescs = groupdescs or {}
+        if revaliases is None:
+            revaliases = {}
+            for base, names in self.aliases.items():
+                for n in names: revaliases[n[0]] = base
+        self.revaliases = revaliases
+        if revgroups is None:
+            revgroups = {}
+            for name, members in self.groups.items():
+                for m in members: revgroups.setdefault(m[0], set()).add(name)
+        self.revgroups = revgroups
+
+    def names(self, user):
+        base = self.revaliases.get(user, user)
+        return [n[0] for n in self.aliases.get(base, ((user, None),))]
+
+    def query_user(self, user):
+        return (self.revaliases.get(user[0], user[0]), user[1])
+
+    def query_aliases(self, base):
+        return list(self.aliases.get(base, ()))
+
+    def list_groups(self):
+        return list(self.groups)
+
+    def query_groups_of(self, user):
+        ret = set()
+        for n in self.names(user):
+            ret.update(self.revgroups.get(n, ()))
+        return sorted(ret)
+
+    def query_group(self, name, raw=False):
+        if raw: return list(self.groups.get(name, ()))
+        return list(OrderedSet.deduplicate(self.groups.get(name, ()),
+            key=lambda x: self.revaliases.get(x[0], x[0])))
+
+    def query_groupdesc(self, name):
+        return self.groupdescs.get(name)
+
+def intern_str(s):
+    return sys.intern(s) if type(s) is str else s
+
+def intern_pairs(items):
+    return [(intern_str(a), intern_str(b)) for a, b in items]
+
 class NotificationDistributorMemory(NotificationDistributor):
-    def __init__(self):
-        self.aliases = {}
-        self.revaliases = {}
-        self.seen = {}
-        self.messages = {}
-        self.deliveries = {}
-        self.groups = {}
-        self.revgroups = {}
-        self.groupdescs = {}
+    # The same few nicks, rooms and reasons recur across many messages and
+    # seen entries; these fields are interned so that one copy is kept.
+    INTERNED_FIELDS = ('from', 'to', 'tonick', 'reason', 'room', 'priority',
+                       'origin')
+    INTERN = True
+
+    # Locking: The inboxes and seen entries are split into stripes by
+    # recipient, each with its own lock; the remaining state (message
+    # index, outboxes, deliveries, mail info, settings) has a lock of its
+    # own. The
+    # alias and group catalog is a CatalogSnapshot read without locking;
+    # the catalog lock only serializes writers. Locks are taken in this
+    # order:
+    #  1. self.lock (held by commands via __enter__),
+    #  2. self.catalog_lock,
+    #  3. stripe locks, in ascending stripe order,
+    #  4. self.state_lock.
+    # Operations spanning aliases resolve them from one snapshot and then
+    # lock the stripes of all the names found; an alias change racing
+    # with them is thus seen entirely or not at all.
+    class Stripe:
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.messages = {}
+            self.seen = {}
+
+    def __init__(self, stripes=LOCK_STRIPES):
+        NotificationDistributor.__init__(self)
+        self.catalog = CatalogSnapshot()
+        self.stripes = [self.Stripe() for i in range(stripes)]
+        self.msgindex = {}
+        self.outboxes = {}
+        self.msgids = itertools.count(1)
+        self.deliveries = collections.OrderedDict()
+        self.claims = {}
         self.mailinfo = {}
         self.settings = {}
         self.lock = threading.RLock()
+        self.catalog_lock = threading.RLock()
+        self.state_lock = threading.Lock()
 
     def __enter__(self):
         self.lock.__enter__()
     def __exit__(self, t, v, tb):
         self.lock.__exit__(t, v, tb)
 
-    def query_user(self, name):
-        ret = self.normalize_user(name)
+    def _stripe(self, name):
+        return self.stripes[hash(name) % len(self.stripes)]
+
+    @contextlib.contextmanager
+    def _locked(self, names):
+        count = len(self.stripes)
+        locks = [self.stripes[i].lock
+                 for i in sorted(set(hash(n) % count for n in names))]
+        for l in locks: l.acquire()
         try:
-            return (self.revaliases[ret[0]], ret[1])
-        except KeyError:
-            return ret
+            yield
+        finally:
+            for l in reversed(locks): l.release()
+
+    def _names_many(self, users):
+        catalog = self.catalog
+        return [catalog.names(u) for u in users]
+
+    def query_user(self, name):
+        return self.catalog.query_user(self.normalize_user(name))
 
     def query_aliases(self, base):
-        with self.lock:
-            return self.aliases.get(base, [])
+        return self.catalog.query_aliases(base)
 
     def update_aliases(self, base, names):
-        with self.lock:
-            # Remove backreferences.
-            for n in self.aliases.pop(base, ()):
-                self.revaliases.pop(n[0], None)
+        if self.INTERN: base, names = intern_str(base), intern_pairs(names)
+        with self.catalog_lock:
+            catalog = self.catalog
+            aliases = dict(catalog.aliases)
+            # Remove old aliases.
+            removed = set(n[0] for n in aliases.pop(base, ()))
+            def publish():
+                self.catalog = CatalogSnapshot(aliases, catalog.groups,
+                    catalog.groupdescs, revgroups=catalog.revgroups)
             # Ensure names is not empty.
-            if not names: return (None, names)
+            if not names:
+                publish()
+                return (None, names)
             # Absorb other aliases.
             nn = OrderedSet.firstel(names)
             seen = set()
             for n in [x[0] for x in nn]: # Avoid concurrent modification.
-                k = self.revaliases.get(n, n)
+                k = n if n in removed else catalog.revaliases.get(n, n)
                 if k in seen: continue
                 seen.add(k)
-                nn.extend(self.aliases.pop(k, ()))
+                nn.update(aliases.pop(k, ()))
             # Choose new base if necessary.
             if (base, None) not in nn: base = names[0][0]
-            # Install alias table.
-            self.aliases[base] = list(nn)
-            # Install backreferences.
-            for n, r in nn: self.revaliases[n] = base
+            # Install alias table (with backreferences).
+            aliases[base] = list(nn)
+            publish()
             # Return new values.
-            return (base, self.aliases[base])
+            return (base, list(nn))
+
+    def _query_seen(self, names):
+        # Must hold the stripe locks of names.
+        entry, unread = None, 0
+        for k in names:
+            e = self._stripe(k).seen.get(k)
+            if not e: continue
+            if entry is None or e[1] is not None and e[1] > entry[1]:
+                entry = e
+            unread += e[2]
+        if not entry: return None
+        return (entry[0], entry[1], unread, entry[3])
 
     def query_seen(self, user):
-        with self.lock:
-            base = self.revaliases.get(user, user)
-            entry, unread = None, 0
-            for k, n in self.aliases.get(base, ((user, None),)):
-                e = self.seen.get(k)
-                if not e: continue
-                if entry is None or e[1] is not None and e[1] > entry[1]:
-                    entry = e
-                unread += e[2]
-            if not entry: return None
-            return (entry[0], entry[1], unread, entry[3])
+        return self.query_seen_many((user,))[0]
+
+    def query_seen_many(self, users):
+        allnames = self._names_many(users)
+        with self._locked(itertools.chain.from_iterable(allnames)):
+            return [self._query_seen(names) for names in allnames]
 
     def update_seen(self, user, name, time, unread, room):
-        with self.lock:
-            oldent = self.seen.get(user, (None, None, 0, None))
-            self.seen[user] = [name, time,
+        if self.INTERN:
+            user, name, room = map(intern_str, (user, name, room))
+        stripe = self._stripe(user)
+        with stripe.lock:
+            oldent = stripe.seen.get(user, (None, None, 0, None))
+            stripe.seen[user] = [name, time,
                 oldent[2] if unread is None else unread, room]
             return (unread != oldent[2])
 
     def list_groups(self):
-        with self.lock:
-            return list(self.groups)
+        return self.catalog.list_groups()
 
     def query_groups_of(self, user):
-        with self.lock:
-            ret = set()
-            base = self.revaliases.get(user, user)
-            for a in self.aliases.get(base, ((user, None),)):
-                ret.update(self.revgroups[a[0]])
-            return sorted(ret)
+        return self.catalog.query_groups_of(user)
+
+    def query_groups_of_many(self, users):
+        catalog = self.catalog
+        return [catalog.query_groups_of(u) for u in users]
 
     def query_group(self, name, raw=False):
-        with self.lock:
-            if raw: return self.groups.get(name, [])
-            return list(OrderedSet.deduplicate(self.groups.get(name, []),
-                key=lambda x: self.revaliases.get(x[0], x[0])))
+        return self.catalog.query_group(name, raw)
 
     def update_group(self, name, members):
-        with self.lock:
-            for e in self.groups.get(name, ()):
-                g = self.revgroups[e[0]]
-                g.discard(name)
-            self.groups[name] = members
-            for e in members:
-                try:
-                    g = self.revgroups[e[0]]
-                except KeyError:
-                    g = set()
-                    self.revgroups[e[0]] = g
-                g.add(name)
-            return self.query_group(name)
+        if self.INTERN: name, members = intern_str(name), intern_pairs(members)
+        with self.catalog_lock:
+            catalog = self.catalog
+            groups = dict(catalog.groups)
+            groups[name] = list(members)
+            self.catalog = CatalogSnapshot(catalog.aliases, groups,
+                catalog.groupdescs, revaliases=catalog.revaliases)
+            return self.catalog.query_group(name)
 
     def query_groupdesc(self, name):
-        with self.lock:
-            return self.groupdescs.get(name)
+        return self.catalog.query_groupdesc(name)
 
     def update_groupdesc(self, name, description):
-        with self.lock:
-            self.groupdescs[name] = description
+        with self.catalog_lock:
+            catalog = self.catalog
+            groupdescs = dict(catalog.groupdescs)
+            groupdescs[name] = description
+            self.catalog = CatalogSnapshot(catalog.aliases, catalog.groups,
+                groupdescs, catalog.revaliases, catalog.revgroups)
+
+    def _inboxes(self, names):
+        # Must hold the stripe locks of names.
+        ret = []
+        for n in names:
+            inbox = self._stripe(n).messages.get(n)
+            if inbox is not None: ret.append(inbox)
+        return ret
+
+    def _message_bounds(self, names):
+        count, oldest, newest = 0, None, None
+        for inbox in self._inboxes(names):
+            c, o, n = inbox.bounds()
+            if not c: continue
+            count += c
+            if oldest is None or o < oldest: oldest = o
+            if newest is None or n > newest: newest = n
+        return (count, oldest, newest)
 
     def message_bounds(self, user):
-        with self.lock:
-            msgs = self.query_messages(user)
-            if not msgs: return (0, None, None)
-            return (len(msgs), min(m['timestamp'] for m in msgs),
-                    max(m['timestamp'] for m in msgs))
+        return self.message_bounds_many((user,))[0]
+
+    def message_bounds_many(self, users):
+        allnames = self._names_many(users)
+        with self._locked(itertools.chain.from_iterable(allnames)):
+            return [self._message_bounds(names) for names in allnames]
 
     def query_messages(self, user, stale=False):
-        with self.lock:
-            base = self.revaliases.get(user, user)
-            names = self.aliases.get(base, ((user, None),))
-            msgs = []
-            for n in names: msgs.extend(self.messages.get(n[0], ()))
-            msgs.sort(key=operator.itemgetter('timestamp'))
-            return msgs
+        names = self._names_many((user,))[0]
+        with self._locked(names):
+            return SortedInbox.merge([i.select(stale)
+                                      for i in self._inboxes(names)])
+
+    def query_message_page(self, user, cursor=None, limit=INBOX_PAGE_SIZE,
+                           stale=False):
+        names = self._names_many((user,))[0]
+        with self._locked(names):
+            lists = [i.select(stale, cursor)[:limit]
+                     for i in self._inboxes(names)]
+            return SortedInbox.merge(lists)[:limit]
 
     def pop_messages(self, user, stale=False):
-        with self.lock:
-            base = self.revaliases.get(user, user)
-            names = self.aliases.get(base, ((user, None),))
-            msgs = []
-            for n in names: msgs.extend(self.messages.pop(n[0], ()))
-            msgs.sort(key=operator.itemgetter('timestamp'))
-            return list(msgs)
+        names = self._names_many((user,))[0]
+        with self._locked(names):
+            msgs = SortedInbox.merge([i.select(stale)
+                                      for i in self._inboxes(names)])
+            now = time.time()
+            for m in msgs:
+                if m.get('delivered') is None:
+                    m['delivered'] = now
+                    self._stripe(m['to']).messages[m['to']].mark_delivered(m)
+            return msgs
+
+    def query_sent_page(self, user, cursor=None, limit=STATUS_PAGE_SIZE):
+        names = self._names_many((user,))[0]
+        with self.state_lock:
+            lists = [self.outboxes[n].before(cursor, limit)
+                     for n in names if n in self.outboxes]
+        return list(itertools.islice(heapq.merge(*lists,
+            key=SortedInbox.KEY, reverse=True), limit))
 
     def add_message(self, user, message):
-        message['id'] = id(message)
         message['to'] = user
-        with self.lock:
-            self.messages.setdefault(user, []).append(message)
+        with self.state_lock:
+            message['id'] = next(self.msgids)
+        return self.restore_message(message)
+
+    def restore_message(self, message):
+        # Store a message that already has its id and recipient.
+        if self.INTERN:
+            for k in self.INTERNED_FIELDS:
+                if k in message: message[k] = intern_str(message[k])
+        if message.get('origin') is None:
+            message['origin'] = normalize_nick(message['from'])
+        user, origin = message['to'], message['origin']
+        stripe = self._stripe(user)
+        with stripe.lock:
+            inbox = stripe.messages.get(user)
+            if inbox is None:
+                inbox = SortedInbox()
+                stripe.messages[user] = inbox
+            with self.state_lock:
+                self.msgindex[message['id']] = message
+                outbox = self.outboxes.get(origin)
+                if outbox is None:
+                    outbox = SortedInbox(False)
+                    self.outboxes[origin] = outbox
+                outbox.add(message)
+            inbox.add(message)
+            return message['id']
 
     def query_delivery(self, msgid):
-        with self.lock:
-            return self.deliveries.get(msgid)
+        with self.state_lock:
+            entry = self.deliveries.get(msgid)
+            if entry is None: return None
+            return {'id': entry[0], 'from': entry[1], 'reason': entry[2],
+                    'delivered_to': msgid, 'delivered': entry[3]}
+
+    def claim_delivery(self, msgid, timeout):
+        now = time.time()
+        with self.state_lock:
+            if self.claims.get(msgid, now) > now: return False
+            self.claims[msgid] = now + timeout
+            return True
 
     def add_delivery(self, msg, msgid, timestamp):
-        with self.lock:
+        with self.state_lock:
+            self.claims.pop(msg['id'], None)
+            msg = self.msgindex.get(msg['id'], msg)
+        stripe = self._stripe(msg.get('to'))
+        with stripe.lock:
+            inbox = stripe.messages.get(msg.get('to'))
+            if inbox is not None and msg.get('delivered') is None:
+                inbox.mark_delivered(msg)
             msg['delivered_to'] = msgid
             msg['delivered'] = timestamp
-            self.deliveries[msgid] = msg
+        with self.state_lock:
+            # Only what is needed to resolve replies is kept, so that the
+            # message itself can be collected independently.
+            self.deliveries[msgid] = (msg['id'], msg['from'], msg['reason'],
+                                      timestamp)
+            while len(self.deliveries) > DELIVERY_MAP_SIZE:
+                self.deliveries.popitem(last=False)
 
     def get_mail_info(self, user):
-        with self.lock:
+        with self.state_lock:
             return self.mailinfo.get(user)
 
     def update_mail_info(self, user, address, throttle):
-        with self.lock:
-            self.mailinfo[user] = [address, throttle]
+        with self.state_lock:
+            entry = self.mailinfo.get(user, (None, None, None, None))
+            self.mailinfo[user] = [address, throttle, entry[2], entry[3]]
 
     def update_mail_throttle(self, user, throttle):
-        with self.lock:
+        with self.state_lock:
             entry = self.mailinfo.get(user)
             if not entry or (entry[1] is not None and entry[1] >= throttle):
                 return
             entry[1] = throttle
 
+    def get_mail_digest(self, user):
+        with self.state_lock:
+            entry = self.mailinfo.get(user)
+            return None if entry is None else (entry[2], entry[3])
+
+    def update_mail_digest(self, user, window):
+        with self.state_lock:
+            entry = self.mailinfo.get(user)
+            if entry: entry[2] = window
+
+    def schedule_mail_digest(self, user, due):
+        with self.state_lock:
+            entry = self.mailinfo.get(user)
+            if entry and entry[3] is None: entry[3] = due
+
+    def pop_mail_digests(self, now):
+        with self.state_lock:
+            ret = []
+            for user, entry in self.mailinfo.items():
+                if entry[3] is not None and entry[3] <= now:
+                    entry[3] = None
+                    ret.append(user)
+            return ret
+
     def init_setting(self, key, value):
-        with self.lock:
+        with self.state_lock:
             self.settings.setdefault(key, value)
 
     def get_setting(self, key):
-        with self.lock:
+        with self.state_lock:
             return self.settings.get(key)
 
     def set_setting(self, key, value):
-        with self.lock:
+        with self.state_lock:
             self.settings[key] = value
+        self._settings_changed(key)
+
+    def maintain(self, full=False):
+        return {'duration': 0, 'reclaimed': 0}
 
     def gc(self):
-        deadline = time.time() - REPLY_TIMEOUT
-        with self.lock:
+        now = time.time()
+        deadline = now - STALE_TIMEOUT
+        with self.state_lock:
             for k, v in tuple(self.deliveries.items()):
-                if v['delivered'] < deadline:
+                if v[3] < now - REPLY_TIMEOUT:
                     del self.deliveries[k]
+            for k, v in tuple(self.claims.items()):
+                if v < now: del self.claims[k]
+        for stripe in self.stripes:
+            dropped = []
+            with stripe.lock:
+                for k, inbox in tuple(stripe.messages.items()):
+                    dropped.extend(inbox.collect(deadline))
+                    if not inbox: del stripe.messages[k]
+            with self.state_lock:
+                for m in dropped: self.msgindex.pop(m['id'], None)
+        with self.state_lock:
+            for k, outbox in tuple(self.outboxes.items()):
+                outbox.collect(deadline)
+                if not outbox: del self.outboxes[k]
 
 class NotificationDistributorSQLite(NotificationDistributor):
-    def __init__(self, filename):
+    def __init__(self, filename, shared=False, profile=None, archive=None):
+        NotificationDistributor.__init__(self)
         self.filename = filename
+        self.archive_filename = archive
+        self.shared = shared
+        self.profile = None
         self.lock = DBLock(None)
         self.conn = None
         self.curs = None
+        self.settings_cache = {}
+        self.data_version = None
+        self.settings_generation = None
+        self.catalog = None
+        self.catalog_generation = None
+        # An explicitly requested profile takes precedence over the
+        # db.profile setting.
+        self.profile_override = profile
+        self.pending_profile = None
         self.init()
+        if archive: self.init_archive()
+        self.apply_profile(profile or self._setting_profile() or
+                           DEFAULT_SQLITE_PROFILE)
+        self._groupcommit_changed(None)
+        self.subscribe_settings(self._profile_changed)
+        self.subscribe_settings(self._groupcommit_changed)
 
     def __enter__(self):
         self.lock.__enter__()
@@ -480,9 +992,14 @@ class NotificationDistributorSQLite(NotificationDistributor):
     def init(self):
         with self.lock.committing:
             self.conn = sqlite3.connect(self.filename, isolation_level='',
-                                        check_same_thread=False)
+                timeout=(SHARED_DB_TIMEOUT if self.shared else 5),
+                check_same_thread=False)
             self.curs = self.conn.cursor()
             self.lock.conn = self.conn
+            # Skip the schema checks if the schema is up to date.
+            if self._query_schema_version() == SCHEMA_VERSION: return
+            # Only takes effect for new databases; see maintain().
+            self.curs.execute('PRAGMA auto_vacuum = INCREMENTAL')
             # Message table.
             self.curs.execute('CREATE TABLE IF NOT EXISTS messages ('
                                   'sender TEXT, '
@@ -493,7 +1010,30 @@ class NotificationDistributorSQLite(NotificationDistributor):
                                   'delivered_to TEXT UNIQUE, '
                                   'delivered REAL, '
                                   'priority TEXT, '
-                                  'room TEXT'
+                                  'room TEXT, '
+                                  'origin TEXT'
+                              ')')
+            self.curs.execute('CREATE INDEX IF NOT EXISTS messages_recipient '
+                'ON messages (recipient, timestamp)')
+            # Delivery table.
+            # Maps the IDs of the posts messages were delivered in to what
+            # is needed to answer !reply and !reply-all; kept independently
+            # of the messages themselves.
+            self.curs.execute('CREATE TABLE IF NOT EXISTS deliveries ('
+                                  'msgid TEXT PRIMARY KEY, '
+                                  'message INTEGER, '
+                                  'sender TEXT, '
+                                  'reason TEXT, '
+                                  'timestamp REAL'
+                              ')')
+            self.curs.execute('CREATE INDEX IF NOT EXISTS '
+                'deliveries_timestamp ON deliveries (timestamp)')
+            # Claim table.
+            # Messages being delivered (by any process) until expires;
+            # see claim_delivery().
+            self.curs.execute('CREATE TABLE IF NOT EXISTS claims ('
+                                  'message INTEGER PRIMARY KEY, '
+                                  'expires REAL'
                               ')')
             # Group table.
             self.curs.execute('CREATE TABLE IF NOT EXISTS groups ('
@@ -527,16 +1067,60 @@ class NotificationDistributorSQLite(NotificationDistributor):
             # throttle is the time when one may send again (or NULL).
             # Inform users that changing their primary alias may prevent them
             # from getting mail.
+            # digest   is the length of the user's digest window in seconds
+            #          (or NULL for the default),
+            # digest_due is the time when the pending digest is to be sent
+            #          (or NULL).
             self.curs.execute('CREATE TABLE IF NOT EXISTS mailinfo ('
                                   'user TEXT PRIMARY KEY, '
                                   'address TEXT, '
-                                  'throttle REAL'
+                                  'throttle REAL, '
+                                  'digest REAL, '
+                                  'digest_due REAL'
                               ')')
             # Configuration table.
             self.curs.execute('CREATE TABLE IF NOT EXISTS settings ('
                                   'name TEXT PRIMARY KEY, '
                                   'value TEXT'
                               ')')
+            # Metadata table.
+            self.curs.execute('CREATE TABLE IF NOT EXISTS meta ('
+                                  'name TEXT PRIMARY KEY, '
+                                  'value'
+                              ')')
+            # Settings generation counter; bumped whenever anyone (including
+            # other processes) changes the settings table so that cached
+            # settings can be invalidated cheaply.
+            self.curs.execute('INSERT OR IGNORE INTO meta VALUES '
+                '(\'settings.generation\', 0)')
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                self.curs.execute('CREATE TRIGGER IF NOT EXISTS '
+                    'settings_%s AFTER %s ON settings BEGIN '
+                        'UPDATE meta SET value = value + 1 '
+                        'WHERE name = \'settings.generation\'; '
+                    'END' % (event.lower(), event))
+            # Highest message ID ever deleted (or archived). Message IDs
+            # are allocated above it so that they are never reused (which
+            # would confuse archived messages with live ones); see
+            # add_message().
+            self.curs.execute('INSERT OR IGNORE INTO meta VALUES '
+                '(\'messages.lastid\', (SELECT IFNULL(MAX(_rowid_), 0) '
+                    'FROM messages))')
+            self.curs.execute('CREATE TRIGGER IF NOT EXISTS messages_delete '
+                'AFTER DELETE ON messages BEGIN '
+                    'UPDATE meta SET value = MAX(value, OLD._rowid_) '
+                    'WHERE name = \'messages.lastid\'; '
+                'END')
+            # Likewise for the alias and group tables.
+            self.curs.execute('INSERT OR IGNORE INTO meta VALUES '
+                '(\'catalog.generation\', 0)')
+            for table in ('aliases', 'groups', 'groupdescs'):
+                for event in ('INSERT', 'UPDATE', 'DELETE'):
+                    self.curs.execute('CREATE TRIGGER IF NOT EXISTS '
+                        '%s_%s AFTER %s ON %s BEGIN '
+                            'UPDATE meta SET value = value + 1 '
+                            'WHERE name = \'catalog.generation\'; '
+                        'END' % (table, event.lower(), event, table))
             # Schema upgrades.
             self.curs.execute('PRAGMA table_info(seen);')
             seencols = set(i[1] for i in self.curs.fetchall())
@@ -546,57 +1130,188 @@ class NotificationDistributorSQLite(NotificationDistributor):
                         'ADD COLUMN ' + coldesc)
             self.curs.execute('PRAGMA table_info(messages);')
             msgcols = set(i[1] for i in self.curs.fetchall())
-            for coldesc in ('priority TEXT', 'room TEXT'):
+            for coldesc in ('priority TEXT', 'room TEXT', 'origin TEXT'):
                 if coldesc.partition(' ')[0] not in msgcols:
                     self.curs.execute('ALTER TABLE messages '
                         'ADD COLUMN ' + coldesc)
+            # origin is the normalized nick of the sender.
+            if 'origin' not in msgcols:
+                self.conn.create_function('tellbot_normalize_nick', 1,
+                                          normalize_nick)
+                self.curs.execute('UPDATE messages '
+                    'SET origin = tellbot_normalize_nick(sender)')
+            self.curs.execute('CREATE INDEX IF NOT EXISTS messages_origin '
+                'ON messages (origin, timestamp)')
+            self.curs.execute('PRAGMA table_info(mailinfo);')
+            mailcols = set(i[1] for i in self.curs.fetchall())
+            for coldesc in ('digest REAL', 'digest_due REAL'):
+                if coldesc.partition(' ')[0] not in mailcols:
+                    self.curs.execute('ALTER TABLE mailinfo '
+                        'ADD COLUMN ' + coldesc)
+            self.curs.execute('INSERT OR REPLACE INTO meta VALUES '
+                '(\'schema.version\', ?)', (SCHEMA_VERSION,))
+
+    def init_archive(self):
+        # The archive lives in a separate file so that the messages table
+        # (and its indexes) stay small. Messages are clustered by
+        # recipient, and their texts are zlib-compressed.
+        with self.lock.committing:
+            self.curs.execute('ATTACH DATABASE ? AS archive',
+                              (self.archive_filename,))
+            self.curs.execute('CREATE TABLE IF NOT EXISTS archive.messages ('
+                                  'recipient TEXT, '
+                                  'timestamp REAL, '
+                                  'id INTEGER, '
+                                  'sender TEXT, '
+                                  'reason TEXT, '
+                                  'text BLOB, '
+                                  'delivered_to TEXT, '
+                                  'delivered REAL, '
+                                  'priority TEXT, '
+                                  'room TEXT, '
+                                  'origin TEXT, '
+                                  'PRIMARY KEY (recipient, timestamp, id)'
+                              ') WITHOUT ROWID')
+            self.curs.execute('PRAGMA archive.table_info(messages)')
+            if 'origin' not in set(i[1] for i in self.curs.fetchall()):
+                self.curs.execute('ALTER TABLE archive.messages '
+                    'ADD COLUMN origin TEXT')
+                self.conn.create_function('tellbot_normalize_nick', 1,
+                                          normalize_nick)
+                self.curs.execute('UPDATE archive.messages '
+                    'SET origin = tellbot_normalize_nick(sender)')
+            self.curs.execute('CREATE INDEX IF NOT EXISTS '
+                'archive.messages_delivered ON messages (delivered)')
+            self.curs.execute('CREATE INDEX IF NOT EXISTS '
+                'archive.messages_origin ON messages (origin, timestamp)')
+            # Archives from before message IDs were kept unique.
+            self.curs.execute('UPDATE meta SET value = MAX(value, '
+                    '(SELECT IFNULL(MAX(id), 0) FROM archive.messages)) '
+                'WHERE name = \'messages.lastid\'')
+
+    def _query_schema_version(self):
+        try:
+            self.curs.execute('SELECT value FROM meta '
+                'WHERE name = \'schema.version\'')
+        except sqlite3.OperationalError:
+            return None
+        res = self.curs.fetchone()
+        return None if res is None else res[0]
+
+    def apply_profile(self, name):
+        try:
+            profile = SQLITE_PROFILES[name]
+        except KeyError:
+            raise ValueError('Unknown database profile: %r' % (name,))
+        with self.lock:
+            self.conn.commit()
+            for key in ('journal_mode', 'synchronous', 'cache_size',
+                        'mmap_size', 'temp_store'):
+                value = profile[key]
+                # Let other processes read while one of them is writing.
+                if key == 'journal_mode' and self.shared: value = 'WAL'
+                self.curs.execute('PRAGMA %s = %s' % (key, value))
+                self.curs.fetchall()
+            self.profile = name
+
+    def _setting_profile(self):
+        name = self.get_setting('db.profile')
+        if name and name not in SQLITE_PROFILES:
+            logging.getLogger('tellbot.distributor').warning('Ignoring '
+                'unknown database profile %r.' % (name,))
+            return None
+        return name
+
+    def _profile_changed(self, key):
+        # Settings listeners run inside others' transactions, which
+        # switching the profile would commit; the switch is thus deferred
+        # to apply_pending_profile() (run by maintain()).
+        if key is not None and key != 'db.profile': return
+        if self.profile_override: return
+        name = self._setting_profile()
+        self.pending_profile = name if name != self.profile else None
+
+    def apply_pending_profile(self):
+        # Must be called without holding the lock.
+        name = self.pending_profile
+        if name is None: return
+        self.pending_profile = None
+        if name != self.profile: self.apply_profile(name)
+
+    def _groupcommit_changed(self, key):
+        # db.groupcommit is the group commit window in milliseconds.
+        if key is not None and key != 'db.groupcommit': return
+        delay = self.get_setting('db.groupcommit')
+        self.lock.group_delay = float(delay) / 1000 if delay else None
+
+    def commit_stats(self):
+        with self.lock.cond:
+            return dict(self.lock.stats)
 
     def _unwrap_message(self, item):
         return {'id': item[0], 'from': item[1], 'to': item[2],
                 'reason': item[3], 'text': item[4], 'timestamp': item[5],
                 'delivered_to': item[6], 'delivered': item[7],
-                'priority': item[8], 'room': item[9]}
+                'priority': item[8], 'room': item[9], 'origin': item[10]}
     def _unwrap_messages(self, it):
         return list(map(self._unwrap_message, it))
     def _wrap_message(self, message):
         return (message.get('id'), message['from'], message['to'],
                 message['reason'], message['text'], message['timestamp'],
                 message.get('delivered_to'), message.get('delivered'),
-                message.get('priority'), message.get('room'))
+                message.get('priority'), message.get('room'),
+                message.get('origin'))
 
-    def query_user(self, name):
-        ret = self.normalize_user(name)
+    def _catalog(self):
+        # Read-through cache of the alias and group tables. Writes through
+        # this connection drop it; writes by others (such as nbimport.py
+        # or a SQLite shell) are noticed by _check_settings().
         with self.lock:
-            self.curs.execute('SELECT base FROM aliases WHERE user = ?',
-                              (ret[0],))
-            res = self.curs.fetchone()
-            if res: return (res[0], ret[1])
-        return ret
+            self._check_settings()
+            if self.catalog is None:
+                self.catalog_generation = self._query_catalog_generation()
+                aliases, groups = {}, {}
+                self.curs.execute('SELECT base, user, name FROM aliases '
+                                  'ORDER BY _rowid_')
+                for base, user, name in self.curs:
+                    aliases.setdefault(base, []).append((user, name))
+                self.curs.execute('SELECT groupname, member, name '
+                                  'FROM groups ORDER BY _rowid_')
+                for group, member, name in self.curs:
+                    groups.setdefault(group, []).append((member, name))
+                self.curs.execute('SELECT groupname, description '
+                                  'FROM groupdescs')
+                self.catalog = CatalogSnapshot(aliases, groups,
+                                               dict(self.curs.fetchall()))
+            return self.catalog
+
+    def query_user(self, name):
+        return self._catalog().query_user(self.normalize_user(name))
 
     def query_aliases(self, base):
-        with self.lock:
-            self.curs.execute('SELECT user, name FROM aliases '
-                'WHERE base = ? ORDER BY _rowid_', (base,))
-            return self.curs.fetchall()
+        return self._catalog().query_aliases(base)
 
     def update_aliases(self, base, names):
         with self.lock.committing:
             # Discard old aliases.
             self.curs.execute('DELETE FROM aliases WHERE base = ?', (base,))
             # Shortcut if there are no aliases to be added.
-            if not names: return (None, names)
+            if not names:
+                self.catalog = None
+                return (None, names)
             # Merge in other aliases if desired.
             nn = OrderedSet.firstel(names)
             for n in [x[0] for x in nn]: # Concurrent modification.
                 self.curs.execute('SELECT user, name FROM aliases '
                     'WHERE base = (SELECT base FROM aliases WHERE user = ?) '
                     'ORDER BY _rowid_', (n,))
-                nn.extend(self.curs.fetchall())
+                nn.update(self.curs.fetchall())
             # Check if we need a new base.
             if (base, None) not in nn: base = names[0][0]
             # Poke all that back into the DB.
             self.curs.executemany('INSERT OR REPLACE INTO aliases '
                 'VALUES (?, ?, ?)', ((base, n, m) for n, m in nn))
+            self.catalog = None
             # Return new values.
             return (base, list(nn))
 
@@ -614,6 +1329,40 @@ class NotificationDistributorSQLite(NotificationDistributor):
             if not entry: return None
             return (entry[0], entry[1], unread, entry[3])
 
+    def _query_many(self, users, query):
+        # Run query once per chunk of users, with a "members" CTE mapping
+        # each requested user ("req") to all of its aliases ("user")
+        # prepended; the first result column must be req.
+        users, ret = list(users), {}
+        for i in range(0, len(users), SQL_BATCH_SIZE):
+            chunk = users[i:i + SQL_BATCH_SIZE]
+            self.curs.execute('WITH req(user) AS (VALUES %s), '
+                'members(req, user) AS (SELECT user, user FROM req '
+                    'UNION SELECT req.user, a2.user FROM req '
+                    'JOIN aliases AS a1 ON a1.user = req.user '
+                    'JOIN aliases AS a2 ON a2.base = a1.base) %s' % (
+                    ', '.join(('(?)',) * len(chunk)), query), chunk)
+            for row in self.curs.fetchall():
+                ret.setdefault(row[0], []).append(row[1:])
+        return ret
+
+    def query_seen_many(self, users):
+        with self.lock:
+            rows = self._query_many(users, 'SELECT members.req, name, '
+                'timestamp, unread, room FROM members '
+                'JOIN seen ON seen.user = members.user')
+            ret = []
+            for user in users:
+                entry, unread = None, 0
+                for e in rows.get(user, ()):
+                    if (entry is None or e[1] is not None and
+                            e[1] > entry[1]):
+                        entry = e
+                    unread += e[2]
+                ret.append(None if entry is None else
+                           (entry[0], entry[1], unread, entry[3]))
+            return ret
+
     def update_seen(self, user, name, timestamp, unread, room):
         with self.lock.committing:
             self.curs.execute('SELECT unread FROM seen WHERE user = ?',
@@ -627,167 +1376,1083 @@ class NotificationDistributorSQLite(NotificationDistributor):
             return (old_unread[0] != unread)
 
     def list_groups(self):
-        with self.lock:
-            self.curs.execute('SELECT DISTINCT groupname FROM groups')
-            return [i[0] for i in self.curs.fetchall()]
+        return self._catalog().list_groups()
+
+    def query_groups_of(self, user):
+        return self._catalog().query_groups_of(user)
+
+    def query_groups_of_many(self, users):
+        catalog = self._catalog()
+        return [catalog.query_groups_of(u) for u in users]
+
+    def query_group(self, name, raw=False):
+        return self._catalog().query_group(name, raw)
+
+    def update_group(self, name, members):
+        with self.lock.committing:
+            self.curs.execute('DELETE FROM groups WHERE groupname = ?',
+                              (name,))
+            self.curs.executemany('INSERT INTO groups VALUES (?, ?, ?)',
+                                  ((name, m, n) for m, n in members))
+            self.catalog = None
+            return self.query_group(name)
+
+    def query_groupdesc(self, name):
+        return self._catalog().query_groupdesc(name)
+
+    def update_groupdesc(self, name, description):
+        with self.lock.committing:
+            self.curs.execute('INSERT OR REPLACE INTO groupdescs '
+                'VALUES (?, ?)', (name, description))
+            self.catalog = None
+
+    def message_bounds(self, user):
+        with self.lock:
+            self.curs.execute('SELECT COUNT(*), MIN(timestamp), '
+                'MAX(timestamp) FROM messages '
+                'WHERE recipient IN (SELECT user FROM aliases '
+                    'WHERE base = (SELECT base FROM aliases WHERE user = ?) '
+                'UNION SELECT ?) AND delivered IS NULL', (user, user))
+            return self.curs.fetchone()
+
+    def message_bounds_many(self, users):
+        with self.lock:
+            rows = self._query_many(users, 'SELECT members.req, COUNT(*), '
+                'MIN(timestamp), MAX(timestamp) FROM members '
+                'JOIN messages ON recipient = members.user '
+                'WHERE delivered IS NULL GROUP BY members.req')
+            return [rows[u][0] if u in rows else (0, None, None)
+                    for u in users]
+
+    def _query_archive(self, user, cursor=None, limit=-1, sent=False):
+        # Messages to user (or, if sent, from user, newest first).
+        if not self.archive_filename: return []
+        import zlib
+        query = ('SELECT id, sender, recipient, reason, text, timestamp, '
+                'delivered_to, delivered, priority, room, origin '
+            'FROM archive.messages '
+            'WHERE %s IN (SELECT user FROM aliases '
+                'WHERE base = (SELECT base FROM aliases WHERE user = ?) '
+            'UNION SELECT ?) %s ORDER BY timestamp %s, id %s LIMIT ?') % (
+            'origin' if sent else 'recipient',
+            '' if cursor is None else
+                'AND (timestamp %(op)s ? OR timestamp = ? AND id %(op)s ?)' %
+                {'op': '<' if sent else '>'},
+            'DESC' if sent else 'ASC', 'DESC' if sent else 'ASC')
+        params = (user, user)
+        if cursor is not None:
+            params += (cursor[0], cursor[0], cursor[1])
+        self.curs.execute(query, params + (limit,))
+        ret = self._unwrap_messages(row[:4] +
+            (zlib.decompress(row[4]).decode('utf-8'),) + row[5:]
+            for row in self.curs.fetchall())
+        # Tagged so that add_delivery() leaves the messages table alone.
+        for m in ret: m['archived'] = True
+        return ret
+
+    def query_messages(self, user, stale=False):
+        with self.lock:
+            query = ('SELECT _rowid_, * FROM messages '
+                'WHERE recipient IN (SELECT user FROM aliases '
+                    'WHERE base = (SELECT base FROM aliases WHERE user = ?) '
+                'UNION SELECT ?) %s ORDER BY timestamp') % (
+                '' if stale else 'AND delivered IS NULL')
+            self.curs.execute(query, (user, user))
+            ret = self._unwrap_messages(self.curs.fetchall())
+            if stale and self.archive_filename:
+                ret.extend(self._query_archive(user))
+                ret.sort(key=SortedInbox.KEY)
+            return ret
+
+    def query_message_page(self, user, cursor=None, limit=INBOX_PAGE_SIZE,
+                           stale=False):
+        with self.lock:
+            query = ('SELECT _rowid_, * FROM messages '
+                'WHERE recipient IN (SELECT user FROM aliases '
+                    'WHERE base = (SELECT base FROM aliases WHERE user = ?) '
+                'UNION SELECT ?) %s %s ORDER BY timestamp, _rowid_ '
+                'LIMIT ?') % (
+                '' if stale else 'AND delivered IS NULL',
+                '' if cursor is None else
+                    'AND (timestamp > ? OR timestamp = ? AND _rowid_ > ?)')
+            params = (user, user)
+            if cursor is not None:
+                params += (cursor[0], cursor[0], cursor[1])
+            self.curs.execute(query, params + (limit,))
+            ret = self._unwrap_messages(self.curs.fetchall())
+            if stale and self.archive_filename:
+                ret.extend(self._query_archive(user, cursor, limit))
+                ret.sort(key=SortedInbox.KEY)
+                del ret[limit:]
+            return ret
+
+    def pop_messages(self, user, stale=False):
+        with self.lock.committing:
+            query = ('SELECT _rowid_, * FROM messages '
+                'WHERE recipient IN (SELECT user FROM aliases WHERE base = '
+                    '(SELECT base FROM aliases WHERE user = ?) '
+                    'UNION SELECT ?) %s ORDER BY timestamp') % (
+                '' if stale else 'AND delivered IS NULL')
+            self.curs.execute(query, (user, user))
+            msgs = self.curs.fetchall()
+            now = time.time()
+            self.curs.executemany('UPDATE messages SET delivered = ? '
+                'WHERE _rowid_ = ? AND delivered IS NULL',
+                ((now, i[0]) for i in msgs))
+            ret = self._unwrap_messages(msgs)
+            if stale and self.archive_filename:
+                ret.extend(self._query_archive(user))
+                ret.sort(key=SortedInbox.KEY)
+            return ret
+
+    def query_sent_page(self, user, cursor=None, limit=STATUS_PAGE_SIZE):
+        # Messages sent by user (and aliases), newest first.
+        with self.lock:
+            query = ('SELECT _rowid_, * FROM messages '
+                'WHERE origin IN (SELECT user FROM aliases '
+                    'WHERE base = (SELECT base FROM aliases WHERE user = ?) '
+                'UNION SELECT ?) %s ORDER BY timestamp DESC, _rowid_ DESC '
+                'LIMIT ?') % (
+                '' if cursor is None else
+                    'AND (timestamp < ? OR timestamp = ? AND _rowid_ < ?)')
+            params = (user, user)
+            if cursor is not None:
+                params += (cursor[0], cursor[0], cursor[1])
+            self.curs.execute(query, params + (limit,))
+            ret = self._unwrap_messages(self.curs.fetchall())
+            if self.archive_filename:
+                ret.extend(self._query_archive(user, cursor, limit, True))
+                ret.sort(key=SortedInbox.KEY, reverse=True)
+                del ret[limit:]
+            return ret
+
+    def add_message(self, user, message):
+        message['to'] = user
+        with self.lock.committing:
+            if message.get('origin') is None:
+                message['origin'] = normalize_nick(message['from'])
+            self.curs.execute('INSERT INTO messages (_rowid_, sender, '
+                    'recipient, reason, text, timestamp, delivered_to, '
+                    'delivered, priority, room, origin) '
+                'VALUES (MAX(IFNULL((SELECT MAX(_rowid_) FROM messages), 0), '
+                    '(SELECT value FROM meta '
+                        'WHERE name = \'messages.lastid\')) + 1, '
+                    '?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                self._wrap_message(message)[1:])
+            message['id'] = self.curs.lastrowid
+            return message['id']
+
+    def query_delivery(self, msgid):
+        with self.lock:
+            self.curs.execute('SELECT message, sender, reason, timestamp '
+                'FROM deliveries WHERE msgid = ?', (msgid,))
+            res = self.curs.fetchone()
+            if res is not None:
+                return {'id': res[0], 'from': res[1], 'reason': res[2],
+                        'delivered_to': msgid, 'delivered': res[3]}
+            # Deliveries from before the delivery table existed.
+            self.curs.execute('SELECT _rowid_, * FROM messages '
+                'WHERE delivered_to = ?', (msgid,))
+            res = self.curs.fetchone()
+            if res is None: return None
+            return self._unwrap_message(res)
+
+    def claim_delivery(self, msgid, timeout):
+        # Atomic across processes, as the DELETE starts a write
+        # transaction.
+        now = time.time()
+        with self.lock.committing:
+            self.curs.execute('DELETE FROM claims '
+                'WHERE message = ? AND expires <= ?', (msgid, now))
+            self.curs.execute('INSERT OR IGNORE INTO claims VALUES (?, ?)',
+                              (msgid, now + timeout))
+            return (self.curs.rowcount == 1)
+
+    def add_delivery(self, msg, msgid, timestamp):
+        with self.lock.committing:
+            self.curs.execute('DELETE FROM claims WHERE message = ?',
+                              (msg['id'],))
+            if not msg.get('archived'):
+                self.curs.execute('UPDATE messages SET delivered_to = ?, '
+                    'delivered = ? WHERE _rowid_ = ?', (msgid, timestamp,
+                                                        msg['id']))
+            self.curs.execute('INSERT OR REPLACE INTO deliveries '
+                'VALUES (?, ?, ?, ?, ?)', (msgid, msg['id'], msg['from'],
+                                           msg['reason'], timestamp))
+
+    def get_mail_info(self, user):
+        with self.lock:
+            self.curs.execute('SELECT address, throttle FROM mailinfo '
+                'WHERE user = ?', (user,))
+            return self.curs.fetchone()
+
+    def update_mail_info(self, user, address, throttle):
+        with self.lock:
+            self.curs.execute('INSERT OR REPLACE INTO mailinfo '
+                'VALUES (?, ?, ?, (SELECT digest FROM mailinfo '
+                    'WHERE user = ?), (SELECT digest_due FROM mailinfo '
+                    'WHERE user = ?))',
+                (user, address, throttle, user, user))
+
+    def update_mail_throttle(self, user, throttle):
+        with self.lock.committing:
+            self.curs.execute('UPDATE mailinfo SET throttle = ? '
+                'WHERE user = ? AND (throttle IS NULL OR throttle < ?)',
+                (throttle, user, throttle))
+
+    def get_mail_digest(self, user):
+        with self.lock:
+            self.curs.execute('SELECT digest, digest_due FROM mailinfo '
+                'WHERE user = ?', (user,))
+            return self.curs.fetchone()
+
+    def update_mail_digest(self, user, window):
+        with self.lock.committing:
+            self.curs.execute('UPDATE mailinfo SET digest = ? '
+                'WHERE user = ?', (window, user))
+
+    def schedule_mail_digest(self, user, due):
+        with self.lock.committing:
+            self.curs.execute('UPDATE mailinfo SET digest_due = ? '
+                'WHERE user = ? AND digest_due IS NULL', (due, user))
+
+    def pop_mail_digests(self, now):
+        with self.lock.committing:
+            self.curs.execute('SELECT user FROM mailinfo '
+                'WHERE digest_due <= ?', (now,))
+            # Other processes may be popping the same digests; only those
+            # whose update takes effect are claimed by this one.
+            users = []
+            for user in [i[0] for i in self.curs.fetchall()]:
+                self.curs.execute('UPDATE mailinfo SET digest_due = NULL '
+                    'WHERE user = ? AND digest_due <= ?', (user, now))
+                if self.curs.rowcount: users.append(user)
+            return users
+
+    def init_setting(self, key, value):
+        with self.lock.committing:
+            self.curs.execute('INSERT OR IGNORE INTO settings VALUES '
+                '(?, ?)', (key, value))
+
+    def init_settings(self, items):
+        items = tuple(items)
+        if not items: return
+        with self.lock.committing:
+            self.curs.execute('INSERT OR IGNORE INTO settings VALUES ' +
+                ', '.join(('(?, ?)',) * len(items)),
+                tuple(itertools.chain.from_iterable(items)))
+
+    def _query_settings_generation(self):
+        self.curs.execute('SELECT value FROM meta '
+            'WHERE name = \'settings.generation\'')
+        return self.curs.fetchone()[0]
+
+    def _query_catalog_generation(self):
+        self.curs.execute('SELECT value FROM meta '
+            'WHERE name = \'catalog.generation\'')
+        return self.curs.fetchone()[0]
+
+    def _check_settings(self):
+        # PRAGMA data_version only changes when another connection has
+        # committed something; only then is the generation counter read.
+        self.curs.execute('PRAGMA data_version')
+        version = self.curs.fetchone()[0]
+        if version == self.data_version: return
+        self.data_version = version
+        if self._query_catalog_generation() != self.catalog_generation:
+            self.catalog = None
+        generation = self._query_settings_generation()
+        if generation == self.settings_generation: return
+        self.settings_generation = generation
+        if self.settings_cache:
+            self.settings_cache.clear()
+            self._settings_changed(None)
+
+    def get_setting(self, key):
+        with self.lock:
+            self._check_settings()
+            try:
+                return self.settings_cache[key]
+            except KeyError:
+                pass
+            self.curs.execute('SELECT value FROM settings WHERE name = ?',
+                              (key,))
+            res = self.curs.fetchone()
+            value = None if res is None else res[0]
+            self.settings_cache[key] = value
+            return value
+
+    def set_setting(self, key, value):
+        if key == 'db.profile' and value and value not in SQLITE_PROFILES:
+            raise ValueError('Unknown database profile: %r' % (value,))
+        with self.lock.committing:
+            self.curs.execute('INSERT OR REPLACE INTO settings VALUES '
+                '(?, ?)', (key, value))
+            self.settings_cache.pop(key, None)
+            self.settings_generation = self._query_settings_generation()
+        self._settings_changed(key)
+
+    def _pragma(self, name):
+        self.curs.execute('PRAGMA %s' % name)
+        return self.curs.fetchone()[0]
+
+    def _maintenance_steps(self, full):
+        # Each step is run with the lock held; the lock is released in
+        # between so that chat traffic is not stalled.
+        if full:
+            yield 'ANALYZE'
+            # Switching to incremental auto-vacuuming requires a VACUUM.
+            if self._pragma('auto_vacuum') != 2:
+                self.curs.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                yield 'VACUUM'
+        else:
+            yield 'PRAGMA optimize'
+        while (self._pragma('auto_vacuum') == 2 and
+               self._pragma('freelist_count')):
+            yield 'PRAGMA incremental_vacuum(%d)' % MAINTENANCE_PAGES
+        if self._pragma('journal_mode') == 'wal':
+            yield 'PRAGMA wal_checkpoint(PASSIVE)'
+
+    def maintain(self, full=False):
+        start = time.time()
+        self.apply_pending_profile()
+        with self.lock:
+            self.conn.commit()
+            size = self._pragma('page_count') * self._pragma('page_size')
+            steps = self._maintenance_steps(full)
+        while 1:
+            with self.lock:
+                try:
+                    stmt = next(steps)
+                except StopIteration:
+                    break
+                self.conn.commit()
+                self.curs.execute(stmt)
+                self.curs.fetchall()
+        with self.lock:
+            reclaimed = size - (self._pragma('page_count') *
+                                self._pragma('page_size'))
+        ret = {'duration': time.time() - start, 'reclaimed': reclaimed,
+               'commits': self.commit_stats()}
+        logger = logging.getLogger('tellbot.distributor')
+        logger.info('Database maintenance done in %.3fs; reclaimed %s '
+            'bytes.' % (ret['duration'], ret['reclaimed']))
+        if ret['commits']['commits']:
+            logger.info('Group commit: %(commits)s commits, %(writes)s '
+                'writes, largest batch %(max_batch)s, %(latency).3fs total '
+                'latency.' % ret['commits'])
+        return ret
+
+    def backup(self):
+        # Copy the database into db.backup.dir (if set) using SQLite's
+        # online backup, and remove all but the db.backup.keep newest
+        # snapshots. Returns a dict with the path, size (in bytes) and
+        # duration of the backup, or None if backups are not configured.
+        directory = self.get_setting('db.backup.dir')
+        if not directory: return None
+        keep = int(self.get_setting('db.backup.keep') or BACKUP_KEEP)
+        prefix = os.path.splitext(os.path.basename(self.filename))[0] + '-'
+        start = time.time()
+        path = os.path.join(directory, prefix + time.strftime(
+            '%Y%m%d-%H%M%S', time.gmtime(start)) + '.sqlite')
+        # Give others a chance to use the connection between steps; writes
+        # made through it meanwhile are carried over by SQLite.
+        def progress(status, remaining, total):
+            self.lock.release()
+            time.sleep(BACKUP_PAUSE)
+            self.lock.acquire()
+        target = sqlite3.connect(path + '.part')
+        try:
+            with self.lock:
+                self.conn.commit()
+                self.conn.backup(target, pages=BACKUP_PAGES,
+                                 progress=progress)
+            target.close()
+            os.rename(path + '.part', path)
+        except Exception:
+            target.close()
+            try:
+                os.remove(path + '.part')
+            except OSError:
+                pass
+            raise
+        ret = {'path': path, 'size': os.path.getsize(path),
+               'duration': time.time() - start}
+        with self.lock.committing:
+            self.curs.executemany('INSERT OR REPLACE INTO meta '
+                'VALUES (?, ?)', (('backup.' + k, v)
+                                  for k, v in sorted(ret.items())))
+        # Rotate old snapshots (but nothing else that might be kept in the
+        # same directory, like the archive).
+        pattern = re.compile(re.escape(prefix) +
+                             r'\d{8}-\d{6}\.sqlite\Z')
+        old = sorted(n for n in os.listdir(directory) if pattern.match(n))
+        for name in old[:-keep] if keep > 0 else ():
+            os.remove(os.path.join(directory, name))
+        logging.getLogger('tellbot.distributor').info('Database backed up '
+            'to %s (%s bytes) in %.3fs.' % (path, ret['size'],
+                                           ret['duration']))
+        return ret
+
+    def archive(self):
+        # Move delivered messages into the archive in batches, releasing
+        # the lock in between; return how many were moved.
+        if not self.archive_filename: return 0
+        import zlib
+        deadline, count = time.time() - ARCHIVE_DELAY, 0
+        while 1:
+            with self.lock.committing:
+                self.curs.execute('SELECT _rowid_, * FROM messages '
+                    'WHERE delivered < ? LIMIT ?',
+                    (deadline, ARCHIVE_BATCH_SIZE))
+                rows = self.curs.fetchall()
+                if not rows: break
+                self.curs.executemany('INSERT OR REPLACE INTO '
+                    'archive.messages '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    ((r[2], r[5], r[0], r[1], r[3],
+                      zlib.compress(r[4].encode('utf-8')), r[6], r[7], r[8],
+                      r[9], r[10]) for r in rows))
+                self.curs.executemany('DELETE FROM messages '
+                    'WHERE _rowid_ = ?', ((r[0],) for r in rows))
+            count += len(rows)
+        if count:
+            logging.getLogger('tellbot.distributor').info('Archived %s '
+                'messages.' % count)
+        return count
+
+    def gc(self):
+        now = time.time()
+        with self.lock.committing:
+            self.curs.execute('DELETE FROM messages WHERE delivered < ?',
+                              (now - STALE_TIMEOUT,))
+            self.curs.execute('DELETE FROM deliveries WHERE timestamp < ?',
+                              (now - REPLY_TIMEOUT,))
+            self.curs.execute('DELETE FROM claims WHERE expires < ?',
+                              (now,))
+            if self.archive_filename:
+                self.curs.execute('DELETE FROM archive.messages '
+                    'WHERE delivered < ?', (now - ARCHIVE_RETENTION,))
+
+# Keeps the catalog, seen entries and pending messages of an SQLite
+# database in a memory distributor. Reads are answered from memory; writes
+# go to both, with the database written first (and the database lock held
+# across both, so they are applied in the same order). Updates of seen
+# entries, which happen on every chat line, are batched and flushed every
+# SEEN_FLUSH_INTERVAL seconds. Delivered messages, deliveries, mail
+# information and settings are left to the database. No other process may
+# write to the database meanwhile.
+class NotificationDistributorCached(NotificationDistributor):
+    def __init__(self, filename, profile=None, archive=None):
+        NotificationDistributor.__init__(self)
+        self.db = NotificationDistributorSQLite(filename, False, profile,
+                                                archive)
+        self.mem = NotificationDistributorMemory()
+        self.lock = self.db.lock
+        self.pending_seen = {}
+        self.pending_since = None
+        self.pending_lock = threading.Lock()
+        self.load()
+
+    def __enter__(self):
+        self.lock.__enter__()
+    def __exit__(self, t, v, tb):
+        self.lock.__exit__(t, v, tb)
+
+    def load(self):
+        with self.lock:
+            self.db.catalog = None
+            self.mem.catalog = self.db._catalog()
+            self.db.curs.execute('SELECT user, name, timestamp, unread, '
+                                 'room FROM seen')
+            for row in self.db.curs.fetchall():
+                self.mem.update_seen(*row)
+            self.db.curs.execute('SELECT _rowid_, * FROM messages '
+                                 'WHERE delivered IS NULL')
+            for m in self.db._unwrap_messages(self.db.curs.fetchall()):
+                self.mem.restore_message(m)
+
+    def flush(self):
+        with self.lock.committing:
+            with self.pending_lock:
+                batch, self.pending_seen = self.pending_seen, {}
+                self.pending_since = None
+            for args in batch.values():
+                self.db.update_seen(*args)
+
+    def check(self):
+        # Compare the cached data with the database; return a list of
+        # human-readable differences.
+        self.flush()
+        ret = []
+        with self.lock:
+            self.db.catalog = None
+            dbcat, memcat = self.db._catalog(), self.mem.catalog
+            if dbcat.aliases != memcat.aliases:
+                ret.append('aliases differ')
+            if dbcat.groups != dict((k, v) for k, v in memcat.groups.items()
+                                    if v):
+                ret.append('groups differ')
+            if dbcat.groupdescs != memcat.groupdescs:
+                ret.append('group descriptions differ')
+            # Databases from before the unread column have NULL there.
+            def normalize_seen(entry):
+                if entry is None: return None
+                return [entry[0], entry[1], entry[2] or 0, entry[3]]
+            self.db.curs.execute('SELECT user, name, timestamp, unread, '
+                                 'room FROM seen')
+            dbseen = dict((r[0], normalize_seen(r[1:]))
+                          for r in self.db.curs.fetchall())
+            memseen = {}
+            for stripe in self.mem.stripes:
+                with stripe.lock:
+                    memseen.update(stripe.seen)
+            for user in set(dbseen) | set(memseen):
+                if dbseen.get(user) != normalize_seen(memseen.get(user)):
+                    ret.append('seen entry of %r differs' % user)
+            self.db.curs.execute('SELECT recipient, _rowid_ FROM messages '
+                                 'WHERE delivered IS NULL')
+            dbpending = collections.defaultdict(set)
+            for user, msgid in self.db.curs.fetchall():
+                dbpending[user].add(msgid)
+            mempending = collections.defaultdict(set)
+            for stripe in self.mem.stripes:
+                with stripe.lock:
+                    for user, inbox in stripe.messages.items():
+                        mempending[user].update(m['id']
+                                                for m in inbox.pending)
+            for user in set(dbpending) | set(mempending):
+                if dbpending[user] != mempending[user]:
+                    ret.append('pending messages of %r differ' % user)
+        return ret
+
+    def query_user(self, name):
+        return self.mem.query_user(name)
+
+    def query_aliases(self, base):
+        return self.mem.query_aliases(base)
+
+    def update_aliases(self, base, names):
+        with self.lock.committing:
+            self.db.update_aliases(base, names)
+            return self.mem.update_aliases(base, names)
+
+    def query_seen(self, user):
+        return self.mem.query_seen(user)
+
+    def query_seen_many(self, users):
+        return self.mem.query_seen_many(users)
+
+    def update_seen(self, user, name, time_, unread, room):
+        ret = self.mem.update_seen(user, name, time_, unread, room)
+        with self.pending_lock:
+            old = self.pending_seen.get(user)
+            if unread is None and old is not None: unread = old[3]
+            self.pending_seen[user] = (user, name, time_, unread, room)
+            if self.pending_since is None: self.pending_since = time.time()
+            due = (time.time() - self.pending_since >= SEEN_FLUSH_INTERVAL)
+        if due: self.flush()
+        return ret
+
+    def list_groups(self):
+        # The database does not keep empty groups around.
+        catalog = self.mem.catalog
+        return [n for n, m in catalog.groups.items() if m]
+
+    def query_groups_of(self, user):
+        return self.mem.query_groups_of(user)
+
+    def query_groups_of_many(self, users):
+        return self.mem.query_groups_of_many(users)
+
+    def query_group(self, name, raw=False):
+        return self.mem.query_group(name, raw)
+
+    def update_group(self, name, members):
+        with self.lock.committing:
+            self.db.update_group(name, members)
+            return self.mem.update_group(name, members)
+
+    def query_groupdesc(self, name):
+        return self.mem.query_groupdesc(name)
+
+    def update_groupdesc(self, name, description):
+        with self.lock.committing:
+            self.db.update_groupdesc(name, description)
+            self.mem.update_groupdesc(name, description)
+
+    def message_bounds(self, user):
+        return self.mem.message_bounds(user)
+
+    def message_bounds_many(self, users):
+        return self.mem.message_bounds_many(users)
+
+    def query_messages(self, user, stale=False):
+        if stale: return self.db.query_messages(user, stale)
+        return self.mem.query_messages(user)
+
+    def query_message_page(self, user, cursor=None, limit=INBOX_PAGE_SIZE,
+                           stale=False):
+        if stale:
+            return self.db.query_message_page(user, cursor, limit, stale)
+        return self.mem.query_message_page(user, cursor, limit)
+
+    def pop_messages(self, user, stale=False):
+        with self.lock.committing:
+            ret = self.db.pop_messages(user, stale)
+            self.mem.pop_messages(user)
+            return ret
+
+    def query_sent_page(self, user, cursor=None, limit=STATUS_PAGE_SIZE):
+        # Delivered messages are not cached.
+        return self.db.query_sent_page(user, cursor, limit)
+
+    def add_message(self, user, message):
+        with self.lock.committing:
+            self.db.add_message(user, message)
+            return self.mem.restore_message(message)
+
+    def query_delivery(self, msgid):
+        return self.db.query_delivery(msgid)
+
+    def claim_delivery(self, msgid, timeout):
+        return self.db.claim_delivery(msgid, timeout)
+
+    def add_delivery(self, msg, msgid, timestamp):
+        with self.lock.committing:
+            self.db.add_delivery(msg, msgid, timestamp)
+            self.mem.add_delivery(msg, msgid, timestamp)
+
+    def get_mail_info(self, user):
+        return self.db.get_mail_info(user)
+
+    def update_mail_info(self, user, address, throttle):
+        self.db.update_mail_info(user, address, throttle)
+
+    def update_mail_throttle(self, user, throttle):
+        self.db.update_mail_throttle(user, throttle)
+
+    def get_mail_digest(self, user):
+        return self.db.get_mail_digest(user)
+
+    def update_mail_digest(self, user, window):
+        self.db.update_mail_digest(user, window)
+
+    def schedule_mail_digest(self, user, due):
+        self.db.schedule_mail_digest(user, due)
+
+    def pop_mail_digests(self, now):
+        return self.db.pop_mail_digests(now)
+
+    def init_setting(self, key, value):
+        self.db.init_setting(key, value)
+
+    def init_settings(self, items):
+        self.db.init_settings(items)
+
+    def get_setting(self, key):
+        return self.db.get_setting(key)
+
+    def set_setting(self, key, value):
+        self.db.set_setting(key, value)
+
+    def subscribe_settings(self, callback):
+        self.db.subscribe_settings(callback)
+
+    def maintain(self, full=False):
+        self.flush()
+        ret = self.db.maintain(full)
+        if full:
+            problems = self.check()
+            logger = logging.getLogger('tellbot.distributor')
+            for p in problems:
+                logger.warning('Cache inconsistency: %s.' % p)
+            ret['mismatches'] = len(problems)
+        return ret
+
+    def archive(self):
+        return self.db.archive()
+
+    def backup(self):
+        self.flush()
+        return self.db.backup()
+
+    def gc(self):
+        self.flush()
+        self.db.gc()
+        self.mem.gc()
+
+class DistributorError(RuntimeError):
+    pass
+
+def parse_address(address):
+    # Addresses without a scheme are Unix socket paths.
+    import socket
+    if address.startswith('unix:'):
+        return (socket.AF_UNIX, address[5:])
+    if not address.startswith('tcp:'):
+        return (socket.AF_UNIX, address)
+    host, sep, port = address[4:].rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError('Bad distributor address: %r' % address)
+    return (socket.AF_INET, (host or 'localhost', int(port)))
+
+# Wire protocol: Each request is a single line containing a JSON array of
+# calls, each of which is an array of a method name and its arguments. The
+# server answers each request with a single line containing a JSON array of
+# results, each of which is either [true, value] or [false, errtype,
+# message]. Requests are processed in order, so clients may pipeline them.
+# The "acquire" (with a "commit" flag) and "release" calls hold the
+# distributor's lock on behalf of the connection until it is released or
+# the connection is closed (which happens if the client sends nothing for
+# REMOTE_LOCK_TIMEOUT seconds while holding it).
+# There is no authentication; access is controlled by the permissions of
+# the Unix socket, and TCP servers only listen on loopback addresses
+# unless told otherwise. Settings cannot be changed through the server
+# (some of them name commands to run).
+# The socketserver classes are only built by create(); this class provides
+# the request handler's behavior.
+class NotificationDistributorServer:
+    METHODS = frozenset(('query_user', 'query_aliases', 'update_aliases',
+        'query_seen', 'query_seen_many', 'update_seen', 'list_groups',
+        'query_groups_of', 'query_groups_of_many', 'query_group',
+        'update_group', 'query_groupdesc', 'update_groupdesc',
+        'message_bounds', 'message_bounds_many', 'query_messages',
+        'query_message_page', 'pop_messages', 'query_sent_page',
+        'add_message', 'query_delivery', 'claim_delivery', 'add_delivery',
+        'get_mail_info',
+        'update_mail_info', 'update_mail_throttle', 'get_mail_digest',
+        'update_mail_digest', 'schedule_mail_digest', 'pop_mail_digests',
+        'get_setting', 'maintain', 'archive', 'backup', 'gc'))
+
+    @classmethod
+    def create(cls, address, distr, public=False):
+        import socket, socketserver, ipaddress
+        family, addr = parse_address(address)
+        if family != socket.AF_UNIX and not public:
+            for info in socket.getaddrinfo(addr[0], addr[1], family):
+                if not ipaddress.ip_address(info[4][0]).is_loopback:
+                    raise ValueError('Refusing to listen on non-loopback '
+                                     'address %r' % address)
+        class Handler(cls, socketserver.StreamRequestHandler):
+            pass
+        class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+            distributor = distr
+        Server.address_family = family
+        return Server(addr, Handler)
+
+    def setup(self):
+        super().setup()
+        self.distr = self.server.distributor
+        self.locks = 0
+
+    def finish(self):
+        while self.locks:
+            self.locks -= 1
+            self.distr.__exit__(None, None, None)
+        super().finish()
+
+    def run_call(self, call):
+        name, args = call[0], call[1:]
+        if name == 'acquire':
+            if args and args[0] and isinstance(self.distr.lock, DBLock):
+                self.distr.lock.acquire(commit=True)
+            else:
+                self.distr.__enter__()
+            self.locks += 1
+            self.connection.settimeout(REMOTE_LOCK_TIMEOUT)
+            return None
+        elif name == 'release':
+            if not self.locks:
+                raise RuntimeError('Releasing unheld lock')
+            self.locks -= 1
+            if not self.locks: self.connection.settimeout(None)
+            return self.distr.__exit__(None, None, None)
+        elif name not in self.METHODS:
+            raise ValueError('Unknown method %r' % (name,))
+        return getattr(self.distr, name)(*args)
+
+    def handle(self):
+        import json
+        # A client stalling while holding the lock times out here, and is
+        # disconnected (which releases the lock).
+        try:
+            for line in self.rfile:
+                results = []
+                for call in json.loads(line.decode('utf-8')):
+                    try:
+                        results.append([True, self.run_call(call)])
+                    except Exception as e:
+                        results.append([False, type(e).__name__, str(e)])
+                self.wfile.write(json.dumps(results).encode('utf-8') + b'\n')
+                self.wfile.flush()
+        except OSError:
+            pass
+
+class NotificationDistributorRemote(NotificationDistributor):
+    # Changes made by other clients are not announced.
+    NOTIFIES_SETTINGS = False
+
+    class Lock:
+        class Committer:
+            def __init__(self, parent):
+                self.parent = parent
+
+            def __enter__(self):
+                self.parent.distr._call('acquire', True)
+
+            def __exit__(self, t, v, tb):
+                self.parent.distr._call('release')
+
+        def __init__(self, distr):
+            self.distr = distr
+            self.committing = self.Committer(self)
+
+        def __enter__(self):
+            self.distr._call('acquire', False)
+
+        def __exit__(self, t, v, tb):
+            self.distr._call('release')
+
+    def __init__(self, address):
+        NotificationDistributor.__init__(self)
+        self.address = address
+        self.lock = self.Lock(self)
+        self.local = threading.local()
+
+    def __enter__(self):
+        self.lock.__enter__()
+    def __exit__(self, t, v, tb):
+        self.lock.__exit__(t, v, tb)
+
+    def _connect(self):
+        # Locks are held per connection, so every thread needs its own.
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            import socket
+            family, addr = parse_address(self.address)
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.connect(addr)
+            conn = (sock, sock.makefile('rb'))
+            self.local.conn = conn
+        return conn
+
+    def call_many(self, calls):
+        import json
+        data = json.dumps([list(c) for c in calls]).encode('utf-8') + b'\n'
+        try:
+            sock, rfile = self._connect()
+            sock.sendall(data)
+            line = rfile.readline()
+        except OSError as exc:
+            line, error = None, exc
+        if not line:
+            # Reconnect on the next call.
+            conn, self.local.conn = getattr(self.local, 'conn', None), None
+            if conn:
+                conn[1].close()
+                conn[0].close()
+            raise DistributorError('Connection to distributor lost' +
+                ('' if line is not None else ': %s' % error))
+        ret = []
+        for res in json.loads(line.decode('utf-8')):
+            if not res[0]:
+                raise DistributorError('%s: %s' % (res[1], res[2]))
+            ret.append(res[1])
+        return ret
+
+    def _call(self, name, *args):
+        return self.call_many(((name,) + args,))[0]
+
+    def _pairs(self, items):
+        return [tuple(i) for i in items]
+
+    def _tuple(self, item):
+        return None if item is None else tuple(item)
+
+    def query_user(self, name):
+        return tuple(self._call('query_user', name))
+
+    def query_aliases(self, base):
+        return self._pairs(self._call('query_aliases', base))
+
+    def update_aliases(self, base, names):
+        base, names = self._call('update_aliases', base, names)
+        return (base, self._pairs(names))
+
+    def query_seen(self, user):
+        return self._tuple(self._call('query_seen', user))
+
+    def query_seen_many(self, users):
+        return [self._tuple(i) for i in
+                self._call('query_seen_many', list(users))]
+
+    def update_seen(self, user, name, time, unread, room):
+        return self._call('update_seen', user, name, time, unread, room)
+
+    def list_groups(self):
+        return self._call('list_groups')
 
     def query_groups_of(self, user):
-        with self.lock:
-            self.curs.execute('SELECT DISTINCT groupname FROM groups '
-                'WHERE member IN (SELECT user FROM aliases '
-                    'WHERE base = (SELECT base FROM aliases WHERE user = ?) '
-                'UNION SELECT ?)', (user, user))
-            return sorted(x[0] for x in self.curs.fetchall())
+        return self._call('query_groups_of', user)
+
+    def query_groups_of_many(self, users):
+        return self._call('query_groups_of_many', list(users))
 
     def query_group(self, name, raw=False):
-        with self.lock:
-            # base is redacted out by the following code
-            self.curs.execute('SELECT base, member, groups.name FROM groups '
-                'LEFT JOIN aliases ON member = user WHERE groupname = ? '
-                'ORDER BY groups._rowid_', (name,))
-            if raw: return [x[1:] for x in self.curs.fetchall()]
-            return list(OrderedSet.deduplicate(self.curs.fetchall(),
-                key=lambda x: x[0] or x[1], map=lambda x: x[1:]))
+        return self._pairs(self._call('query_group', name, raw))
 
     def update_group(self, name, members):
-        with self.lock.committing:
-            self.curs.execute('DELETE FROM groups WHERE groupname = ?',
-                              (name,))
-            self.curs.executemany('INSERT INTO groups VALUES (?, ?, ?)',
-                                  ((name, m, n) for m, n in members))
-            return self.query_group(name)
+        return self._pairs(self._call('update_group', name, members))
 
     def query_groupdesc(self, name):
-        with self.lock:
-            self.curs.execute('SELECT description FROM groupdescs '
-                'WHERE groupname = ?', (name,))
-            res = self.curs.fetchone()
-            return res[0] if res else None
+        return self._call('query_groupdesc', name)
 
     def update_groupdesc(self, name, description):
-        with self.lock.committing:
-            self.curs.execute('INSERT OR REPLACE INTO groupdescs '
-                'VALUES (?, ?)', (name, description))
+        return self._call('update_groupdesc', name, description)
 
     def message_bounds(self, user):
-        with self.lock:
-            self.curs.execute('SELECT COUNT(*), MIN(timestamp), '
-                'MAX(timestamp) FROM messages '
-                'WHERE recipient IN (SELECT user FROM aliases '
-                    'WHERE base = (SELECT base FROM aliases WHERE user = ?) '
-                'UNION SELECT ?) AND delivered IS NULL', (user, user))
-            return self.curs.fetchone()
+        return tuple(self._call('message_bounds', user))
+
+    def message_bounds_many(self, users):
+        return [tuple(i) for i in
+                self._call('message_bounds_many', list(users))]
 
     def query_messages(self, user, stale=False):
-        with self.lock:
-            query = ('SELECT _rowid_, * FROM messages '
-                'WHERE recipient IN (SELECT user FROM aliases '
-                    'WHERE base = (SELECT base FROM aliases WHERE user = ?) '
-                'UNION SELECT ?) %s ORDER BY timestamp') % (
-                '' if stale else 'AND delivered IS NULL')
-            self.curs.execute(query, (user, user))
-            return self._unwrap_messages(self.curs.fetchall())
+        return self._call('query_messages', user, stale)
+
+    def query_message_page(self, user, cursor=None, limit=INBOX_PAGE_SIZE,
+                           stale=False):
+        return self._call('query_message_page', user, cursor, limit, stale)
 
     def pop_messages(self, user, stale=False):
-        with self.lock.committing:
-            query = ('SELECT _rowid_, * FROM messages '
-                'WHERE recipient IN (SELECT user FROM aliases WHERE base = '
-                    '(SELECT base FROM aliases WHERE user = ?) '
-                    'UNION SELECT ?) %s ORDER BY timestamp') % (
-                '' if stale else 'AND delivered IS NULL')
-            self.curs.execute(query, (user, user))
-            msgs = self.curs.fetchall()
-            now = time.time()
-            self.curs.executemany('UPDATE messages SET delivered = ? '
-                'WHERE _rowid_ = ? AND delivered IS NULL',
-                ((now, i[0]) for i in msgs))
-            return self._unwrap_messages(msgs)
+        return self._call('pop_messages', user, stale)
+
+    def query_sent_page(self, user, cursor=None, limit=STATUS_PAGE_SIZE):
+        return self._call('query_sent_page', user, cursor, limit)
 
     def add_message(self, user, message):
         message['to'] = user
-        with self.lock.committing:
-            self.curs.execute('INSERT INTO messages '
-                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                self._wrap_message(message)[1:])
+        message['id'] = self._call('add_message', user, message)
+        return message['id']
 
     def query_delivery(self, msgid):
-        with self.lock:
-            self.curs.execute('SELECT _rowid_, * FROM messages '
-                'WHERE delivered_to = ?', (msgid,))
-            res = self.curs.fetchone()
-            if res is None: return None
-            return self._unwrap_message(res)
+        return self._call('query_delivery', msgid)
+
+    def claim_delivery(self, msgid, timeout):
+        return self._call('claim_delivery', msgid, timeout)
 
     def add_delivery(self, msg, msgid, timestamp):
-        with self.lock.committing:
-            self.curs.execute('UPDATE messages SET delivered_to = ?, '
-                'delivered = ? WHERE _rowid_ = ?', (msgid, timestamp,
-                                                    msg['id']))
+        msg['delivered_to'] = msgid
+        msg['delivered'] = timestamp
+        return self._call('add_delivery', msg, msgid, timestamp)
 
     def get_mail_info(self, user):
-        with self.lock:
-            self.curs.execute('SELECT address, throttle FROM mailinfo '
-                'WHERE user = ?', (user,))
-            return self.curs.fetchone()
+        return self._tuple(self._call('get_mail_info', user))
 
     def update_mail_info(self, user, address, throttle):
-        with self.lock:
-            self.curs.execute('INSERT OR REPLACE INTO mailinfo '
-                'VALUES (?, ?, ?)', (user, address, throttle))
+        return self._call('update_mail_info', user, address, throttle)
 
     def update_mail_throttle(self, user, throttle):
-        with self.lock.committing:
-            self.curs.execute('UPDATE mailinfo SET throttle = ? '
-                'WHERE user = ? AND (throttle IS NULL OR throttle < ?)',
-                (throttle, user, throttle))
+        return self._call('update_mail_throttle', user, throttle)
+
+    def get_mail_digest(self, user):
+        return self._tuple(self._call('get_mail_digest', user))
+
+    def update_mail_digest(self, user, window):
+        return self._call('update_mail_digest', user, window)
 
+    def schedule_mail_digest(self, user, due):
+        return self._call('schedule_mail_digest', user, due)
+
+    def pop_mail_digests(self, now):
+        return self._call('pop_mail_digests', now)
+
+    # Settings are managed by the server.
     def init_setting(self, key, value):
-        with self.lock.committing:
-            self.curs.execute('INSERT OR IGNORE INTO settings VALUES '
-                '(?, ?)', (key, value))
+        raise DistributorError('Settings cannot be changed remotely')
 
     def get_setting(self, key):
-        with self.lock:
-            self.curs.execute('SELECT value FROM settings WHERE name = ?',
-                              (key,))
-            res = self.curs.fetchone()
-            return None if res is None else res[0]
+        return self._call('get_setting', key)
 
     def set_setting(self, key, value):
-        with self.lock.committing:
-            self.curs.execute('INSERT OR REPLACE INTO settings VALUES '
-                '(?, ?)', (key, value))
+        raise DistributorError('Settings cannot be changed remotely')
+
+    def maintain(self, full=False):
+        return self._call('maintain', full)
+
+    def archive(self):
+        return self._call('archive')
+
+    def backup(self):
+        return self._call('backup')
 
     def gc(self):
-        deadline = time.time() - REPLY_TIMEOUT
-        with self.lock.committing:
-            self.curs.execute('DELETE FROM messages WHERE delivered < ?',
-                              (deadline,))
+        return self._call('gc')
 
 class Mailer:
+    ADDRSPEC_RE = re.compile('^[^<]+ <([^>]+)>$')
+
     @classmethod
     def extract_addrspec(cls, address):
-        m = re.match('^[^<]+ <([^>]+)>$', address)
+        m = cls.ADDRSPEC_RE.match(address)
         return m.group(1) if m else None
 
-    @classmethod
-    def init_settings(cls, distr):
+    DEFAULT_SETTINGS = (
         # Send mail?
-        distr.init_setting('mail', 'no')
+        ('mail', 'no'),
         # What to send mail with (currently only "sendmail")
-        distr.init_setting('mail.backend', 'sendmail')
+        ('mail.backend', 'sendmail'),
         # Sender address ("TellBot <tellbot@example.com>")
-        distr.init_setting('mail.from', None)
+        ('mail.from', None),
         # Envelope sender address (derived from mail.from as default; no
         # angled brackets)
-        distr.init_setting('mail.realfrom', None)
+        ('mail.realfrom', None),
         # Tag to prepend to the auto-generated subject in square brackets
-        distr.init_setting('mail.subjtag', None)
+        ('mail.subjtag', None),
         # Which command to use as sendmail
-        distr.init_setting('mail.sendmail.command', 'sendmail')
+        ('mail.sendmail.command', 'sendmail'),
+        # Default length of the window (in seconds) over which non-urgent
+        # notifications are collected into a single digest (if any)
+        ('mail.digest', None)
+    )
+
+    @classmethod
+    def init_settings(cls, distr):
+        distr.init_settings(cls.DEFAULT_SETTINGS)
 
     def __init__(self, distr):
         self.distr = distr
+        self._config = None
+        distr.subscribe_settings(self._setting_changed)
+
+    def _setting_changed(self, key):
+        if key is None or key.startswith('mail.'): self.invalidate()
+
+    def invalidate(self):
+        self._config = None
+
+    def _get_config(self):
+        # The settings are only re-read after invalidate() is called (or
+        # every time if the distributor cannot tell about changes).
+        config = self._config
+        if config is not None: return config
+        full_from = self.distr.get_setting('mail.from')
+        if full_from is None:
+            raise RuntimeError('mail.from not configured')
+        real_from = self.distr.get_setting('mail.realfrom')
+        if real_from is None:
+            real_from = self.extract_addrspec(full_from)
+            if real_from is None:
+                raise RuntimeError('Ill-formatted mail.from')
+        digest = self.distr.get_setting('mail.digest')
+        config = {'from': asciienc(full_from), 'realfrom': real_from,
+                  'subjtag': self.distr.get_setting('mail.subjtag'),
+                  'digest': float(digest) if digest else None}
+        if self.distr.NOTIFIES_SETTINGS: self._config = config
+        return config
 
     def allow_send(self, message):
         info = self.distr.get_mail_info(message['to'])
@@ -799,64 +2464,158 @@ class Mailer:
         else:
             return True
 
+    def digest_window(self, user):
+        info = self.distr.get_mail_digest(user)
+        if info is not None and info[0] is not None: return info[0]
+        return self._get_config()['digest']
+
+    def allow_digest(self, user):
+        info = self.distr.get_mail_info(user)
+        return (info is not None and
+                (info[1] is None or info[1] <= time.time()))
+
     def format_send(self, message):
-        def asciienc(s):
-            return s.encode('ascii').decode('ascii')
-        def utfenc(s):
-            return s
-        def htmlenc(s):
-            return escape(s).encode('ascii',
-                errors='xmlcharrefreplace').decode('ascii')
+        return self._format_send_one(self._get_config(), {}, message)
+
+    def format_send_many(self, messages):
+        # The messages of a broadcast share everything but the recipient,
+        # so the parts depending on the message alone are rendered once.
+        # Messages that cannot be rendered (e.g. because of a bad address)
+        # yield None instead of spoiling the rest.
+        config, common, ret = self._get_config(), {}, []
+        for message in messages:
+            try:
+                ret.append(self._format_send_one(config, common, message))
+            except (ValueError, UnicodeError):
+                logging.getLogger('tellbot.mailer').warning('Cannot mail '
+                    '@%s' % message.get('tonick', message['to']),
+                    exc_info=True)
+                ret.append(None)
+        return ret
+
+    def _format_send_one(self, config, common, message):
+        msg_priority = message['priority']
+        key = (message['from'], message['reason'], msg_priority,
+               message['text'])
+        fields = common.get(key)
+        if fields is None:
+            msg_from = make_mention(message['from'])
+            msg_to = message['reason']
+            fields = {
+                'from': config['from'],
+                'plain_from': msg_from,
+                'plain_to': msg_to,
+                'plain_prio': msg_priority,
+                'plain_text': message['text'],
+                'html_from': htmlenc(msg_from),
+                'html_to': htmlenc(msg_to),
+                'html_prio': htmlenc(msg_priority),
+                'html_text': htmlenc(message['text']).replace('\n',
+                                                             '<br/>')
+            }
+            common[key] = fields
         minfo = self.distr.get_mail_info(message['to'])
         binfo = self.distr.message_bounds(message['to'])
-        full_from = self.distr.get_setting('mail.from')
-        if full_from is None:
-            raise RuntimeError('mail.from not configured')
-        real_from = self.distr.get_setting('mail.realfrom')
-        if real_from is None:
-            real_from = self.extract_addrspec(full_from)
-            if real_from is None:
-                raise RuntimeError('Ill-formatted mail.from')
         real_to = self.extract_addrspec(minfo[0])
         if real_to is None:
             raise ValueError('Ill-formatted recipient address')
-        msg_priority = message['priority']
         subject = 'New%s TellBot message (%s unread)' % (
             (' urgent' if msg_priority == 'URGENT' else ''), binfo[0])
-        subjtag = self.distr.get_setting('mail.subjtag')
-        if subjtag is not None: subject = '[%s] %s' % (subjtag, subject)
-        msg_from = make_mention(message['from'])
-        msg_to = message['reason']
-        return (real_from, real_to, (EMAIL_NOTIFICATION_TEMPLATE % {
-            'from': asciienc(full_from),
+        if config['subjtag'] is not None:
+            subject = '[%s] %s' % (config['subjtag'], subject)
+        return (config['realfrom'], real_to,
+                (EMAIL_NOTIFICATION_TEMPLATE % dict(fields,
+            to=asciienc(minfo[0]),
+            subject=asciienc(subject),
+            boundary=base64.b64encode(os.urandom(16)).decode('ascii'),
+            unread_total=binfo[0]
+        )).encode('utf-8'))
+
+    def format_digest(self, user):
+        config = self._get_config()
+        minfo = self.distr.get_mail_info(user)
+        unread, oldest, newest = self.distr.message_bounds(user)
+        if not unread: return None
+        real_to = self.extract_addrspec(minfo[0])
+        if real_to is None:
+            raise ValueError('Ill-formatted recipient address')
+        messages = self.distr.query_message_page(user,
+                                                 limit=DIGEST_MAX_MESSAGES)
+        plain, html = [], []
+        for message in messages:
+            fields = (make_mention(message['from']), message['reason'],
+                      message['priority'], message['text'])
+            plain.append('\nFrom: %s\nTo: %s\nPriority: %s\nText: %s\n' %
+                         fields)
+            html.append('      <tr><td>%s</td><td>%s</td><td>%s</td>'
+                        '<td>%s</td></tr>' % (htmlenc(fields[0]),
+                htmlenc(fields[1]), htmlenc(fields[2]),
+                htmlenc(fields[3]).replace('\n', '<br/>')))
+        if unread > len(messages):
+            more = ('%s more messages are waiting; use !inbox to read '
+                    'them.' % (unread - len(messages)))
+        else:
+            more = ''
+        subject = 'TellBot digest (%s unread)' % unread
+        if config['subjtag'] is not None:
+            subject = '[%s] %s' % (config['subjtag'], subject)
+        when = basebot.format_datetime(oldest, False)
+        return (config['realfrom'], real_to, (EMAIL_DIGEST_TEMPLATE % {
+            'from': config['from'],
             'to': asciienc(minfo[0]),
             'subject': asciienc(subject),
             'boundary': base64.b64encode(os.urandom(16)).decode('ascii'),
-            'unread_total': binfo[0],
-            'plain_from': utfenc(msg_from),
-            'plain_to': utfenc(msg_to),
-            'plain_prio': utfenc(msg_priority),
-            'plain_text': utfenc(message['text']),
-            'html_from': htmlenc(msg_from),
-            'html_to': htmlenc(msg_to),
-            'html_prio': htmlenc(msg_priority),
-            'html_text': htmlenc(message['text']).replace('\n', '<br/>')
+            'unread_total': unread,
+            'plain_oldest': when,
+            'plain_messages': ''.join(plain),
+            'plain_more': '\n' + more + '\n' if more else '',
+            'html_oldest': htmlenc(when),
+            'html_messages': '\n'.join(html),
+            'html_more': '<p>%s</p>' % htmlenc(more) if more else ''
         }).encode('utf-8'))
 
-    def send(self, message):
+    def deliver(self, sender, recipient, data):
         raise NotImplementedError
 
+    def send(self, message):
+        return self.deliver(*self.format_send(message))
+
+    def send_digest(self, user):
+        mail = self.format_digest(user)
+        if mail is None: return None
+        return self.deliver(*mail)
+
+    async def deliver_async(self, events, sender, recipient, data):
+        return await events.run_blocking(self.deliver, sender, recipient,
+                                         data)
+
+    async def send_many_async(self, events, messages):
+        rendered = await events.run_blocking(self.format_send_many,
+                                             messages)
+        ret = []
+        for item in rendered:
+            if item is None:
+                ret.append(None)
+                continue
+            try:
+                ret.append(await self.deliver_async(events, *item))
+            except Exception:
+                logging.getLogger('tellbot.mailer').error('Error while '
+                    'sending mail to <%s>' % item[1], exc_info=True)
+                ret.append(None)
+        return ret
+
 class MailerNull(Mailer):
     def allow_send(self, message):
         return False
 
-    def send(self, message):
+    def deliver(self, sender, recipient, data):
         return None
 
 class MailerSendmail(Mailer):
-    def send(self, message):
-        sender, recipient, data = self.format_send(message)
+    def deliver(self, sender, recipient, data):
         cmd = self.distr.get_setting('mail.sendmail.command')
+        import subprocess
         proc = subprocess.Popen([cmd, '-f', sender, recipient],
                                 stdin=subprocess.PIPE)
         proc.stdin.write(re.sub(b'(?m)^\.', b'..', data) + b'\n.\n')
@@ -866,30 +2625,119 @@ class MailerSendmail(Mailer):
         else:
             return None
 
+    async def deliver_async(self, events, sender, recipient, data):
+        cmd = await events.run_blocking(self.distr.get_setting,
+                                        'mail.sendmail.command')
+        proc = await asyncio.create_subprocess_exec(cmd, '-f', sender,
+            recipient, stdin=asyncio.subprocess.PIPE)
+        await proc.communicate(re.sub(b'(?m)^\.', b'..', data) + b'\n.\n')
+        if proc.returncode == 0:
+            return (sender, recipient, data)
+        else:
+            return None
+
+class PresenceIndex:
+    # Tracks which users are in which of the manager's rooms (counting
+    # sessions), and whose inboxes are known to be empty. The latter is
+    # only sound if no other process writes to the distributor, so it can
+    # be turned off. The generation counter is bumped by invalidate(), so
+    # that a user whose inbox was found empty is not marked as such if a
+    # message arrived meanwhile (for anyone; a spurious miss only costs a
+    # query).
+    def __init__(self, track_empty=True):
+        self.track_empty = track_empty
+        self.lock = threading.Lock()
+        self.rooms = {}
+        self.empty = set()
+        self.notified = set()
+        self.generation = 0
+
+    def reset(self, bot, users):
+        # Replace the sessions of bot by those of users (e.g. from a
+        # snapshot after (re)connecting).
+        with self.lock:
+            for user in tuple(self.rooms):
+                entry = self.rooms[user]
+                entry.pop(bot, None)
+                if not entry: del self.rooms[user]
+            for user in users:
+                entry = self.rooms.setdefault(user, {})
+                entry[bot] = entry.get(bot, 0) + 1
+
+    def enter(self, user, bot):
+        with self.lock:
+            entry = self.rooms.setdefault(user, {})
+            entry[bot] = entry.get(bot, 0) + 1
+
+    def leave(self, user, bot):
+        with self.lock:
+            entry = self.rooms.get(user)
+            if not entry or bot not in entry: return
+            entry[bot] -= 1
+            if entry[bot] <= 0: del entry[bot]
+            if not entry: del self.rooms[user]
+
+    def locate(self, users):
+        with self.lock:
+            ret = []
+            for u in users:
+                for bot in self.rooms.get(u, ()):
+                    if bot not in ret: ret.append(bot)
+            return ret
+
+    def is_empty(self, user):
+        with self.lock:
+            return user in self.empty
+
+    def mark_empty(self, user, generation):
+        with self.lock:
+            if self.track_empty and generation == self.generation:
+                self.empty.add(user)
+            self.notified.discard(user)
+
+    def mark_notified(self, user):
+        with self.lock:
+            if user in self.notified: return False
+            self.notified.add(user)
+            return True
+
+    def mark_read(self, user):
+        with self.lock:
+            self.notified.discard(user)
+
+    def invalidate(self, users):
+        # Messages may reach a user through any of their aliases, so the
+        # caller passes all of them.
+        with self.lock:
+            self.empty.difference_update(users)
+            self.generation += 1
+
 class TellBot(basebot.Bot):
     BOTNAME = 'TellBot'
     NICKNAME = 'TellBot'
     SHORT_HELP = 'I can schedule messages to be delivered to other users.'
     LONG_HELP = HELP_TEXT
 
+    DEFAULT_SETTINGS = (
+        # NotBot fallback mode
+        ('nbfallback', 'no'),
+    )
+
     @classmethod
     def init_settings(cls, distr):
-        # NotBot fallback mode
-        distr.init_setting('nbfallback', 'no')
+        distr.init_settings(cls.DEFAULT_SETTINGS)
 
     def __init__(self, *args, **kwds):
         basebot.Bot.__init__(self, *args, **kwds)
         self._tasklock = threading.RLock()
-        self._runner = None
-        self._task_queue = None
         self._pending = {}
 
     def _format_nick(self, nick, ping=True, subject=None, title=False):
-        nnick = basebot.normalize_nick(nick)
+        nnick = normalize_nick(nick)
         ttr = (titlefirst if title else lambda x: x)
-        if nnick == basebot.normalize_nick(self.nickname):
+        if nnick == normalize_nick(self.nickname):
             return ttr('me')
-        elif subject and nnick == basebot.normalize_nick(subject):
+        elif subject and nnick == normalize_nick(subject):
             return ttr('you')
         else:
             return (make_mention if ping else seminormalize_nick)(nick)
@@ -897,7 +2745,15 @@ class TellBot(basebot.Bot):
     def _format_users(self, users, groups, subject, prevent_self=False,
                       ping=True):
         if not users: return ('no-one', {})
-        tr = lambda x: self._format_nick(x[1], ping, subject[1])
+        # Group entries carry their normalized nicks already, so the special
+        # cases can be matched without normalizing every member again.
+        special = {subject[0]: 'you',
+                   normalize_nick(self.nickname): 'me'}
+        render = make_mention if ping else seminormalize_nick
+        def tr(item):
+            ret = special.get(item[0])
+            if ret is not None: return ret
+            return render(item[1])
         seen, segnames, segments, reasons = set(), [], {}, {}
         for n, c in groups.items():
             if n.startswith('@'):
@@ -917,14 +2773,24 @@ class TellBot(basebot.Bot):
                     reasons[normnick] = n
                 segnames.append(n)
                 segments[n] = collections.OrderedDict(
-                    (i[0], tr(i)) for i in nc)
+                    (i[0], i) for i in nc)
                 seen.update(i[0] for i in nc)
-        parts = []
+        # Members are only rendered as long as the output is not too long.
+        # (That bounds the work per group, so rendered groups are not
+        # cached; a cache would also depend on the subject and on which
+        # members earlier segments took.)
+        parts, budget = [], RECIPIENT_LIST_LIMIT
         for n in segnames:
             if n not in segments:
                 parts.append(n)
+                budget -= len(n) + 2
                 continue
-            names = list(segments[n].values())
+            names = []
+            for item in segments[n].values():
+                if budget <= 0: break
+                name = tr(item)
+                names.append(name)
+                budget -= len(name) + 2
             if not groups[n]:
                 names.append('-empty-')
             elif len(names) != len(groups[n]):
@@ -932,34 +2798,20 @@ class TellBot(basebot.Bot):
             parts.append('%s (%s)' % (n, format_list(names)))
         return (format_list(parts, 'no-one'), reasons)
 
-    def _spawn_task_runner(self):
-        self._task_queue = Queue()
-        self._runner = basebot.spawn_thread(self._task_runner)
-
-    def _task_runner(self):
-        queue = self._task_queue
-        while 1:
-            task = queue.get()
-            try:
-                time.sleep(task.time - time.time())
-            except ValueError:
-                pass
-            try:
-                with self._tasklock:
-                    self._pending.pop(task.id, None)
-                if not task.canceled: task()
-            finally:
-                queue.task_done()
+    def _run_task(self, task):
+        with self._tasklock:
+            self._pending.pop(task.id, None)
+        if not task.canceled: task.func()
 
     def _schedule_task(self, delay, func, *args, **kwds):
         tid = kwds.pop('_id')
-        t = lambda: func(*args, **kwds)
-        t.time = time.time() + delay
+        t = lambda: self._run_task(t)
+        t.func = lambda: func(*args, **kwds)
         t.canceled = False
         t.id = tid
         with self._tasklock:
             if tid: self._pending[tid] = t
-            self._task_queue.put(t)
+            self.manager.events.call_later(delay, t)
 
     def _cancel_task(self, tid):
         with self._tasklock:
@@ -975,7 +2827,13 @@ class TellBot(basebot.Bot):
 
         # Update online time database.
         if meta['edit'] or meta['long']: return
-        unread, oldest, newest = distr.message_bounds(user[0])
+        presence = self.manager.presence
+        if presence.is_empty(user[0]):
+            unread, oldest, newest = 0, None, None
+        else:
+            generation = presence.generation
+            unread, oldest, newest = distr.message_bounds(user[0])
+            if not unread: presence.mark_empty(user[0], generation)
         update = distr.update_seen(user[0], user[1], now, unread,
                                    self.roomname)
         distr.update_mail_throttle(user[0], time.time() + MAIL_SEEN_COOLOFF)
@@ -1003,6 +2861,37 @@ class TellBot(basebot.Bot):
                 reply(('You have %s unread messages; use !inbox to read '
                        'them. ' % unread) + REPLY_HELP)
 
+    def handle_packet(self, packet):
+        basebot.Bot.handle_packet(self, packet)
+        # Every (re)connection starts with a snapshot of the room.
+        if packet['type'] == 'snapshot-event':
+            self.manager.presence.reset(self, [normalize_nick(s['name'])
+                for s in packet['data']['listing'] if s.get('name')])
+
+    def handle_join(self, session, meta):
+        basebot.Bot.handle_join(self, session, meta)
+        self.manager.presence.enter(normalize_nick(session['name']), self)
+
+    def handle_part(self, session, meta):
+        basebot.Bot.handle_part(self, session, meta)
+        self.manager.presence.leave(normalize_nick(session['name']), self)
+
+    def handle_nick_change(self, data, meta):
+        basebot.Bot.handle_nick_change(self, data, meta)
+        presence = self.manager.presence
+        presence.leave(normalize_nick(data['from']), self)
+        presence.enter(normalize_nick(data['to']), self)
+
+    def _push_notify(self, user, nick, names):
+        # Tell recipients who are around in another room right away (but
+        # only once until they have read their messages). The index is
+        # keyed by nick, so names lists all of user's aliases.
+        presence = self.manager.presence
+        bots = [b for b in presence.locate(names) if b is not self]
+        if not bots or not presence.mark_notified(user): return
+        bots[0].send_chat('%s, you have a new message; use !inbox to read '
+                          'it.' % make_mention(nick))
+
     def send_notify(self, sender, recipients, groups, text, reply,
                     reason=None, priority='normal', ping=False):
         distr, mailer = self.manager.distributor, self.manager.mailer
@@ -1019,55 +2908,112 @@ class TellBot(basebot.Bot):
             return
 
         # Schedule messages.
-        base = {'text': text, 'from': sender[1], 'timestamp': time.time(),
-                'priority': priority, 'room': self.roomname}
+        base = {'text': text, 'from': sender[1], 'origin': sender[0],
+                'timestamp': time.time(), 'priority': priority,
+                'room': self.roomname}
+        messages = []
         for user, nick in recipients:
             cur_reason = reason or reasons[user]
             message = dict(base, to=user, tonick=nick, reason=cur_reason)
             distr.add_message(user, message)
+            messages.append((message, [user] + [n[0] for n in
+                                                distr.query_aliases(user)]))
+        # Only the recipients' cached empty inboxes are voided, once for
+        # the whole broadcast.
+        self.manager.presence.invalidate([n for m, names in messages
+                                          for n in names])
+        mails = []
+        for message, names in messages:
+            user = message['to']
+            self._push_notify(user, message['tonick'], names)
             try:
-                if mailer.allow_send(message):
-                    res = mailer.send(message)
-                    distr.update_mail_throttle(user, base['timestamp'] +
-                                               MAIL_SEND_COOLOFF)
-                    if res is None:
-                        self.logger.info('Sending mail to @%s failed.' %
-                                         nick)
-                    else:
-                        self.logger.info('Sent mail to @%s <%s>.' %
-                                         (nick, res[1]))
+                if not mailer.allow_send(message):
+                    pass
+                elif (priority != 'URGENT' and
+                        mailer.digest_window(user)):
+                    distr.schedule_mail_digest(user, base['timestamp'] +
+                                               mailer.digest_window(user))
+                else:
+                    # Throttled once the mail has actually been sent.
+                    mails.append(message)
             except Exception as e:
                 self.logger.error('Error while sending mail', exc_info=True)
+        if mails:
+            self.manager.events.submit(self._send_mails(mailer, mails))
 
         # Reply.
         reply('Will tell %s.' % reclist)
 
-    def deliver_notifies(self, distr, sender, reply, stale=False):
+    async def _send_mails(self, mailer, messages):
+        events = self.manager.events
+        try:
+            results = await mailer.send_many_async(events, messages)
+            for message, res in zip(messages, results):
+                if res is None:
+                    self.logger.info('Sending mail to @%s failed.' %
+                                     message['tonick'])
+                    continue
+                self.logger.info('Sent mail to @%s <%s>.' %
+                                 (message['tonick'], res[1]))
+                await events.run_blocking(
+                    self.manager.distributor.update_mail_throttle,
+                    message['to'], message['timestamp'] + MAIL_SEND_COOLOFF)
+        except Exception:
+            self.logger.error('Error while sending mail', exc_info=True)
+
+    def _format_reason(self, src, subject):
         # Format a delivery reason.
-        def format_reason(src):
-            if src.startswith('<re> '):
-                return 'replying ' + format_reason(src[5:])
-            elif src.startswith('@'):
-                return 'to ' + self._format_nick(src[1:], False, sender[1])
-            else:
-                return 'to ' + src
+        if src.startswith('<re> '):
+            return 'replying ' + self._format_reason(src[5:], subject)
+        elif src.startswith('@'):
+            return 'to ' + self._format_nick(src[1:], False, subject)
+        else:
+            return 'to ' + src
+
+    def deliver_notifies(self, distr, sender, reply, stale=False,
+                         explicit=False):
+        # Fetch the next page of messages after the cursor.
+        def fill_page():
+            if page or cursor[1]: return
+            page.extend(distr.query_message_page(sender[0], cursor[0],
+                INBOX_PAGE_SIZE, stale))
+            if len(page) < INBOX_PAGE_SIZE: cursor[1] = True
+
+        # Fetch the next message, advancing the cursor. Messages being
+        # delivered by another process (e.g. in another room) are
+        # skipped.
+        def next_message():
+            while 1:
+                fill_page()
+                if not page: return None
+                m = page.popleft()
+                cursor[0] = (m['timestamp'], m['id'])
+                if distr.claim_delivery(m['id'], DELIVERY_TIMEOUT): return m
+
+        # Release the delivery session of the user.
+        def finish():
+            with mgr.inbox_lock:
+                mgr.inbox_sessions.pop(sender[0], None)
+            mgr.presence.mark_read(sender[0])
 
         # Actually deliver a message.
         def deliver_message():
             # Add a delivery notice.
             def handle_delivery(reply):
                 distr.add_delivery(m, reply.data.id, reply.data.time)
+                with mgr.inbox_lock:
+                    mgr.inbox_sessions[sender[0]] = time.time()
                 # HACK: Wait a bit to avoid being kicked for spamming.
-                if len(messages) > 10: time.sleep(1)
+                if paced: time.sleep(1)
                 deliver_message()
-            try:
-                m = next(msgitr)
-            except StopIteration:
+            m = next_message()
+            if m is None:
+                finish()
                 return
             if m['reason'] == make_mention(sender[1]):
                 reason = ''
             else:
-                reason = ' ' + format_reason(m['reason'])
+                reason = ' ' + self._format_reason(m['reason'], sender[1])
             roomname = m.get('room')
             if roomname is None or roomname == self.roomname:
                 room = ''
@@ -1079,18 +3025,126 @@ class TellBot(basebot.Bot):
                 basebot.format_delta(time.time() - m['timestamp'], False),
                 m['text']), handle_delivery)
 
+        # Only run one delivery per user at a time; messages are marked
+        # as delivered only when their replies are acknowledged, so a
+        # concurrent run would deliver them twice.
+        mgr, now = self.manager, time.time()
+        with mgr.inbox_lock:
+            last = mgr.inbox_sessions.get(sender[0])
+            if last is not None and last > now - DELIVERY_TIMEOUT:
+                if explicit: reply('Delivery already in progress.')
+                return
+            mgr.inbox_sessions[sender[0]] = now
+
         # Deliver messages.
-        now = time.time()
-        messages = distr.pop_messages(sender[0], stale)
-        msgitr = iter(messages)
+        page, cursor = collections.deque(), [None, False]
+        fill_page()
+        paced, empty = (len(page) > 10), (not page)
         deliver_message()
         distr.update_seen(sender[0], sender[1], now, 0,
                           self.roomname)
 
         # ...Or none.
-        if not messages:
+        if empty:
             reply('No mail.')
 
+    def list_sent(self, distr, sender, reply, more=False):
+        # Continue after the last listed message if asked to.
+        mgr = self.manager
+        with mgr.inbox_lock:
+            cursor = mgr.status_cursors.get(sender[0]) if more else None
+        if more and cursor is None:
+            reply('Nothing more to list.')
+            return
+
+        # Messages sent to several recipients at once (e.g. to a group)
+        # are listed together; fetch until one entry more than fits on a
+        # page is seen, so that all entries shown are complete.
+        entries, done = collections.OrderedDict(), False
+        while len(entries) <= STATUS_PAGE_SIZE and not done:
+            msgs = distr.query_sent_page(sender[0], cursor,
+                                         STATUS_FETCH_SIZE)
+            done = (len(msgs) < STATUS_FETCH_SIZE)
+            for m in msgs:
+                key = (m['timestamp'], m['text'])
+                if key not in entries and len(entries) > STATUS_PAGE_SIZE:
+                    break
+                entries.setdefault(key, []).append(m)
+            if msgs: cursor = (msgs[-1]['timestamp'], msgs[-1]['id'])
+        has_more = (len(entries) > STATUS_PAGE_SIZE)
+        groups = list(entries.values())[:STATUS_PAGE_SIZE]
+        with mgr.inbox_lock:
+            if has_more:
+                last = groups[-1][-1]
+                mgr.status_cursors[sender[0]] = (last['timestamp'],
+                                                 last['id'])
+            else:
+                mgr.status_cursors.pop(sender[0], None)
+        if not groups:
+            reply('No recent messages.' if not more else
+                  'Nothing more to list.')
+            return
+
+        # Format the listing. Direct recipients are named by the reason
+        # (the database does not keep the nicks of recipients); replies
+        # have theirs prefixed with "<re> ".
+        def target(m):
+            reason = m['reason']
+            return reason[5:] if reason.startswith('<re> ') else reason
+        def is_direct(m):
+            return (target(m).startswith('@') and (not m.get('tonick') or
+                target(m) == make_mention(m['tonick'])))
+        def format_nicks(msgs):
+            nicks = [self._format_nick(target(m)[1:] if is_direct(m) else
+                                       m.get('tonick') or m['to'], False,
+                                       sender[1]) for m in msgs]
+            if len(nicks) <= STATUS_NICK_COUNT: return ', '.join(nicks)
+            return '%s and %s more' % (', '.join(nicks[:STATUS_NICK_COUNT]),
+                                       len(nicks) - STATUS_NICK_COUNT)
+        now, lines = time.time(), []
+        for msgs in groups:
+            m = msgs[0]
+            verb = 'replying to' if m['reason'].startswith('<re> ') else 'to'
+            if len(msgs) == 1:
+                recipient = format_nicks(msgs)
+                if is_direct(m):
+                    reason = ''
+                else:
+                    reason = ' (%s)' % self._format_reason(target(m),
+                                                           sender[1])
+                if m.get('delivered') is None:
+                    state = 'pending'
+                else:
+                    state = 'delivered %s ago' % basebot.format_delta(
+                        now - m['delivered'], False)
+                head = '%s %s%s' % (verb, recipient, reason)
+            else:
+                # Name the groups rather than all of their members.
+                targets = []
+                for r in msgs:
+                    name = format_nicks((r,)) if is_direct(r) else target(r)
+                    if name not in targets: targets.append(name)
+                delivered, pending = [], []
+                for r in msgs:
+                    (pending if r.get('delivered') is None
+                     else delivered).append(r)
+                states = []
+                if delivered:
+                    states.append('delivered to ' + format_nicks(delivered))
+                if pending:
+                    states.append('pending for ' + format_nicks(pending))
+                state = '; '.join(states)
+                head = '%s %s' % (verb, ', '.join(targets))
+            text = m['text']
+            if len(text) > STATUS_TEXT_LENGTH:
+                text = text[:STATUS_TEXT_LENGTH - 3] + '...'
+            lines.append('[%s, %s ago] %s: %s' % (head,
+                basebot.format_delta(now - m['timestamp'], False), state,
+                text))
+        if has_more:
+            lines.append('(Use !tstatus --more to list older messages.)')
+        reply('\n'.join(lines))
+
     def handle_command(self, cmdline, meta):
         basebot.Bot.handle_command(self, cmdline, meta)
         self.process_command(cmdline, meta)
@@ -1128,7 +3182,7 @@ class TellBot(basebot.Bot):
                     r = check_policy('group', False)
                     if r: return r
                     g = distr.query_group(arg[1:])
-                    base.extend(g)
+                    base.update(g)
                     groups[arg] = g
                     count += 1
                 elif arg.startswith('+@'): # Add user (long form).
@@ -1142,7 +3196,7 @@ class TellBot(basebot.Bot):
                     r = check_policy('group', True)
                     if r: return r
                     g = distr.query_group(arg[2:])
-                    base.extend(g)
+                    base.update(g)
                     groups[arg[1:]] = g
                     count += 1
                 elif arg.startswith('-@'): # Discard user.
@@ -1153,7 +3207,7 @@ class TellBot(basebot.Bot):
                 elif arg.startswith('-*'): # Discard group.
                     r = check_policy('group', True)
                     if r: return r
-                    base.discard_all(distr.query_group(arg[2:]))
+                    base.difference_update(distr.query_group(arg[2:]))
                     count += 1
                 elif arg.startswith('--'): # Option.
                     return arg, count
@@ -1341,6 +3395,7 @@ class TellBot(basebot.Bot):
                     filt = lambda x: True
                     filt_all = True
                 elif len(cmdline) == 2:
+                    import fnmatch
                     regex = re.compile(fnmatch.translate(cmdline[1]), re.I)
                     filt = regex.match
                     filt_all = False
@@ -1394,8 +3449,8 @@ class TellBot(basebot.Bot):
                     return
 
                 # Actually output into.
-                for user, nick in users:
-                    groups = sorted(distr.query_groups_of(user))
+                allgroups = distr.query_groups_of_many([u[0] for u in users])
+                for (user, nick), groups in zip(users, allgroups):
                     count = ' (%s)' % len(groups) if groups else ''
                     reply('Groups of %s%s: %s' % (format_nick((user, nick),
                         ping), count, format_list(['*' + i for i in groups],
@@ -1477,7 +3532,7 @@ class TellBot(basebot.Bot):
                     if cmdline[0] == '!tungroup':
                         removes = members
                         members = OrderedSet.firstel(old_members)
-                        members.discard_all(removes)
+                        members.difference_update(removes)
                     nmembers = distr.update_group(groupname, list(members))
                     display_group(groupname, nmembers, ping, 'after')
 
@@ -1531,8 +3586,10 @@ class TellBot(basebot.Bot):
                 if cmdline[0] == '!unalias':
                     removes = names
                     names = OrderedSet.firstel(old_names)
-                    names.discard_all(removes)
+                    names.difference_update(removes)
                 nbase, nnames = distr.update_aliases(base[0], list(names))
+                self.manager.presence.invalidate([n[0] for n in
+                    OrderedSet.firstel(list(old_names) + list(nnames))])
 
                 # Display new membership.
                 if nnames:
@@ -1562,11 +3619,13 @@ class TellBot(basebot.Bot):
                     return
 
                 # Output information.
-                now, bnn = time.time(), basebot.normalize_nick
-                for user, nick in users:
-                    seen = distr.query_seen(user)
+                now, bnn = time.time(), normalize_nick
+                names = [u[0] for u in users]
+                for (user, nick), seen, bounds in zip(users,
+                        distr.query_seen_many(names),
+                        distr.message_bounds_many(names)):
                     if seen is None: seen = (None, None, 0, None)
-                    unread, oldest, newest = distr.message_bounds(user)
+                    unread, oldest, newest = bounds
                     if not unread:
                         pm = ''
                     elif unread == 1:
@@ -1611,18 +3670,134 @@ class TellBot(basebot.Bot):
                         reply('Unknown option %r.' % arg)
 
                 # Deliver messages.
-                self.deliver_notifies(distr, sender, meta['reply'], stale)
+                self.deliver_notifies(distr, sender, meta['reply'], stale,
+                                      True)
+
+            # List sent messages.
+            elif cmdline[0] == '!tstatus':
+                self._log_command(cmdline)
+                more = False
+                for arg in cmdline[1:]:
+                    if arg == '--more':
+                        more = True
+                    else:
+                        reply('Unknown option %r.' % arg)
+                        return
+                self.list_sent(distr, sender, reply, more)
+
+            # Configure mail digests.
+            elif cmdline[0] == '!tdigest':
+                self._log_command(cmdline)
+                if distr.get_mail_info(sender[0]) is None:
+                    reply('You have no mail address on file.')
+                    return
+                if len(cmdline) > 2:
+                    reply('Please specify at most one argument.')
+                    return
+                elif len(cmdline) == 2:
+                    if cmdline[1] == '--off':
+                        window = 0
+                    elif cmdline[1] == '--default':
+                        window = None
+                    else:
+                        try:
+                            window = float(cmdline[1]) * 3600
+                            if not 0 < window < float('inf'):
+                                raise ValueError
+                        except ValueError:
+                            reply('Invalid digest window %r.' % cmdline[1])
+                            return
+                    distr.update_mail_digest(sender[0], window)
+                window = self.manager.mailer.digest_window(sender[0])
+                if window:
+                    reply('Notifications are collected into digests every '
+                          '%s.' % basebot.format_delta(window))
+                else:
+                    reply('Notifications are mailed individually.')
+
+            # Database maintenance.
+            elif cmdline[0] == '!tmaintain':
+                self._log_command(cmdline)
+                if (not meta['msg'].sender.is_manager and
+                        not meta['msg'].sender.is_staff):
+                    reply('Only room hosts may run maintenance.')
+                    return
+                full = False
+                for arg in cmdline[1:]:
+                    if arg == '--full':
+                        full = True
+                    else:
+                        reply('Unknown option %r.' % arg)
+                        return
+
+                # The maintenance would be stalled by the lock held here.
+                def run(reply=meta['reply']):
+                    try:
+                        res = distr.maintain(full)
+                    except Exception as exc:
+                        self.logger.error('Error during database '
+                                          'maintenance', exc_info=True)
+                        reply('Maintenance failed: %s' % exc)
+                        return
+                    # Refreshing the statistics may grow the database.
+                    if res['reclaimed'] >= 0:
+                        change = 'reclaimed %s KiB' % (
+                            res['reclaimed'] // 1024)
+                    else:
+                        change = 'database grew by %s KiB' % (
+                            -res['reclaimed'] // 1024)
+                    text = 'Maintenance done in %s; %s.' % (
+                        basebot.format_delta(res['duration']), change)
+                    stats = res.get('commits')
+                    if stats and stats['commits']:
+                        text += (' Group commit: %s writes in %s commits, '
+                            'average latency %.1f ms.' % (stats['writes'],
+                            stats['commits'],
+                            stats['latency'] * 1000 / stats['writes']))
+                    if res.get('mismatches'):
+                        text += (' Cache check: %s inconsistencies (see '
+                                 'the log).' % res['mismatches'])
+                    reply(text)
+                self.manager.events.call_later(0, run)
+                reply('Maintenance started.')
+
+            # Back up the database.
+            elif cmdline[0] == '!tbackup':
+                self._log_command(cmdline)
+                if (not meta['msg'].sender.is_manager and
+                        not meta['msg'].sender.is_staff):
+                    reply('Only room hosts may run backups.')
+                    return
+                if len(cmdline) > 1:
+                    reply('Unknown option %r.' % cmdline[1])
+                    return
+
+                # Like maintenance, this needs the lock held here.
+                def run(reply=meta['reply']):
+                    try:
+                        res = distr.backup()
+                    except Exception as exc:
+                        self.logger.error('Error during database backup',
+                                          exc_info=True)
+                        reply('Backup failed: %s' % exc)
+                        return
+                    if res is None:
+                        reply('Backups are not configured.')
+                        return
+                    reply('Backup done in %s; wrote %s KiB.' % (
+                        basebot.format_delta(res['duration']),
+                        res['size'] // 1024))
+                self.manager.events.call_later(0, run)
+                reply('Backup started.')
 
         # Unlock database, deliver replies.
         finally:
             distr.__exit__(None, None, None)
             flush()
 
-    def main(self):
-        self._spawn_task_runner()
-        basebot.Bot.main(self)
-
 class GCThread(threading.Thread):
+    INTERVAL = GC_INTERVAL
+
     def __init__(self, distr):
         threading.Thread.__init__(self)
         self.distr = distr
@@ -1637,8 +3812,8 @@ class GCThread(threading.Thread):
     def run(self):
         cont = True
         while cont:
-            self.distr.gc()
-            wakeup = time.time() + GC_INTERVAL
+            self.step()
+            wakeup = time.time() + self.INTERVAL
             with self.cond:
                 while not self.exiting:
                     now = time.time()
@@ -1647,6 +3822,106 @@ class GCThread(threading.Thread):
                 else:
                     break
 
+    def step(self):
+        self.distr.archive()
+        self.distr.gc()
+
+class MailDigestThread(GCThread):
+    INTERVAL = DIGEST_INTERVAL
+
+    def __init__(self, distr, mailer):
+        GCThread.__init__(self, distr)
+        self.mailer = mailer
+        self.logger = logging.getLogger('tellbot.digest')
+
+    def step(self):
+        for user in self.distr.pop_mail_digests(time.time()):
+            try:
+                # Do not bother users who came back in the meantime.
+                if not self.mailer.allow_digest(user): continue
+                res = self.mailer.send_digest(user)
+                if res is None: continue
+                self.distr.update_mail_throttle(user, time.time() +
+                                                MAIL_SEND_COOLOFF)
+                self.logger.info('Sent mail digest to <%s>.' % res[1])
+            except Exception:
+                self.logger.error('Error while sending mail digest',
+                                  exc_info=True)
+
+class MaintenanceThread(GCThread):
+    INTERVAL = MAINTENANCE_INTERVAL
+
+    def __init__(self, distr):
+        GCThread.__init__(self, distr)
+        self.started = False
+
+    def step(self):
+        # Do not slow down startup.
+        if not self.started:
+            self.started = True
+            return
+        try:
+            self.distr.maintain()
+        except Exception:
+            logging.getLogger('tellbot.distributor').error('Error during '
+                'database maintenance', exc_info=True)
+
+class SeenFlushThread(GCThread):
+    INTERVAL = SEEN_FLUSH_INTERVAL
+
+    def run(self):
+        GCThread.run(self)
+        self.step()
+
+    def step(self):
+        self.distr.flush()
+
+class BackupThread(MaintenanceThread):
+    INTERVAL = BACKUP_INTERVAL
+
+    def step(self):
+        if not self.started:
+            self.started = True
+            return
+        try:
+            self.distr.backup()
+        except Exception:
+            logging.getLogger('tellbot.distributor').error('Error during '
+                'database backup', exc_info=True)
+
+class EventLoopThread(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.loop = asyncio.new_event_loop()
+        # Blocking distributor calls are funneled through a single thread.
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.executor.shutdown(wait=False)
+            self.loop.close()
+
+    def call_later(self, delay, func):
+        # The task may block (e.g. on the database), so it is not run on
+        # the loop itself.
+        def fire():
+            self.loop.run_in_executor(None, func)
+        def schedule():
+            self.loop.call_at(self.loop.time() + delay, fire)
+        self.loop.call_soon_threadsafe(schedule)
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run_blocking(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, *args)
+
 class TellBotManager(basebot.BotManager):
     @classmethod
     def prepare_parser(cls, parser, config):
@@ -1654,14 +3929,37 @@ class TellBotManager(basebot.BotManager):
         parser.add_argument('--db', metavar='PATH',
                             help='SQLite database file for message '
                               'persistence (default in-memory)')
+        parser.add_argument('--db-profile', metavar='NAME',
+                            choices=sorted(SQLITE_PROFILES),
+                            help='SQLite performance profile (one of %s; '
+                              'default taken from the db.profile setting, '
+                              'or %s)' % (', '.join(sorted(SQLITE_PROFILES)),
+                                          DEFAULT_SQLITE_PROFILE))
+        parser.add_argument('--db-cache', action='store_true',
+                            help='Keep the database contents in memory, '
+                              'writing changes through (requires --db; '
+                              'not with --workers)')
+        parser.add_argument('--archive', metavar='PATH',
+                            help='SQLite database file to move delivered '
+                              'messages into (requires --db)')
+        parser.add_argument('--remote', metavar='ADDRESS',
+                            help='Use the distributor server listening at '
+                              'ADDRESS ([unix:]PATH or tcp:HOST:PORT) '
+                              'instead of a local database')
         parser.add_argument('--config', action='append', dest='confopts',
                             metavar='KEY=VALUE',
                             help='A setting to apply before starting')
+        parser.add_argument('--workers', metavar='N', type=int,
+                            help='Spread the rooms over N worker processes '
+                              'sharing the database (requires --db)')
+        parser.add_argument('--shard', metavar='INDEX/COUNT',
+                            help='Only run every COUNT-th room, starting '
+                              'from the INDEX-th one (used by --workers)')
 
     @classmethod
     def interpret_args(cls, arguments, config):
         bots, config = basebot.BotManager.interpret_args(arguments, config)
-        for name in ('db',):
+        for name in ('db', 'db_profile', 'db_cache', 'archive', 'remote'):
             value = getattr(arguments, name)
             if value is not None:
                 config[name] = value
@@ -1672,20 +3970,93 @@ class TellBotManager(basebot.BotManager):
             except ValueError:
                 raise SystemExit('Bad configuration value: %r' % el)
             config['confopts'].append((n, v))
+        if config.get('db_cache') and not config.get('db'):
+            raise SystemExit('--db-cache requires a --db.')
+        if config.get('archive') and not config.get('db'):
+            raise SystemExit('--archive requires a --db.')
+        if config.get('remote') and config['confopts']:
+            raise SystemExit('--config cannot be used with --remote (pass '
+                             'it to the distributor server instead).')
+        if arguments.workers is not None or arguments.shard is not None:
+            if not config.get('db') and not config.get('remote'):
+                raise SystemExit('Multiple processes require a --db or '
+                                 '--remote.')
+            if config.get('db_cache'):
+                raise SystemExit('--db-cache cannot be used with multiple '
+                                 'processes.')
+        if arguments.shard is not None:
+            try:
+                index, count = map(int, arguments.shard.split('/', 1))
+            except ValueError:
+                raise SystemExit('Bad shard specification: %r' %
+                                 arguments.shard)
+            if not 0 <= index < count:
+                raise SystemExit('Bad shard specification: %r' %
+                                 arguments.shard)
+            bots = bots[index::count]
+            config['shared'] = (count > 1)
+            config['shard_index'] = index
+        elif arguments.workers is not None:
+            if arguments.workers < 1:
+                raise SystemExit('Bad worker count: %r' % arguments.workers)
+            raise SystemExit(cls.run_workers(arguments.workers))
         return (bots, config)
 
+    @classmethod
+    def run_workers(cls, count):
+        # Every room is handled by exactly one worker, so the scheduled
+        # NotBot fallbacks (which are per-room) never need to be canceled
+        # across process boundaries.
+        import subprocess
+        argv = [sys.executable, sys.argv[0]] + sys.argv[1:]
+        procs = [subprocess.Popen(argv + ['--shard', '%s/%s' % (i, count)])
+                 for i in range(count)]
+        # If any worker exits, the others are taken down, too (rather
+        # than leaving its rooms offline unnoticed).
+        try:
+            while 1:
+                codes = [p.poll() for p in procs]
+                if any(c is not None for c in codes):
+                    return max(c for c in codes if c is not None)
+                time.sleep(1)
+        finally:
+            for p in procs:
+                if p.poll() is None: p.terminate()
+
     def __init__(self, **config):
         basebot.BotManager.__init__(self, **config)
         self.db = config.get('db', None)
+        self.db_profile = config.get('db_profile', None)
+        self.db_cache = config.get('db_cache', False)
+        self.archive = config.get('archive', None)
+        self.remote = config.get('remote', None)
         self.orig_conf = config.get('confopts', [])
-        if self.db:
-            self.distributor = NotificationDistributorSQLite(self.db)
+        self.inbox_lock = threading.Lock()
+        self.inbox_sessions = {}
+        self.status_cursors = {}
+        self.shared = config.get('shared', False)
+        self.shard_index = config.get('shard_index', 0)
+        self.presence = PresenceIndex(not (self.remote or self.shared))
+        if self.remote:
+            self.distributor = NotificationDistributorRemote(self.remote)
+        elif self.db and self.db_cache:
+            self.distributor = NotificationDistributorCached(self.db,
+                self.db_profile, self.archive)
+        elif self.db:
+            self.distributor = NotificationDistributorSQLite(self.db,
+                self.shared, self.db_profile, self.archive)
         else:
             self.distributor = NotificationDistributorMemory()
-        TellBot.init_settings(self.distributor)
-        Mailer.init_settings(self.distributor)
-        for n, v in self.orig_conf:
-            self.distributor.set_setting(n, v)
+        # The distributor server manages the settings of its clients.
+        if not self.remote:
+            self.distributor.init_settings(TellBot.DEFAULT_SETTINGS +
+                                           Mailer.DEFAULT_SETTINGS)
+            for n, v in self.orig_conf:
+                self.distributor.set_setting(n, v)
+            # Profile switches are deferred; this is a safe place.
+            db = getattr(self.distributor, 'db', self.distributor)
+            if isinstance(db, NotificationDistributorSQLite):
+                db.apply_pending_profile()
         do_mail = self.distributor.get_setting('mail')
         mail_backend = self.distributor.get_setting('mail.backend')
         if not is_true(do_mail) or mail_backend == 'null':
@@ -1695,6 +4066,17 @@ class TellBotManager(basebot.BotManager):
         else:
             raise RuntimeError('mail.backend not configured although mail '
                 'is enabled')
+        self.events = EventLoopThread()
+        self.children.append(self.events)
         self.children.append(GCThread(self.distributor))
+        # Scheduled maintenance and backups are left to the distributor
+        # server or the first shard, respectively.
+        if not self.remote and self.shard_index == 0:
+            self.children.append(MaintenanceThread(self.distributor))
+            self.children.append(BackupThread(self.distributor))
+        self.children.append(MailDigestThread(self.distributor,
+                                              self.mailer))
+        if isinstance(self.distributor, NotificationDistributorCached):
+            self.children.append(SeenFlushThread(self.distributor))
 
 if __name__ == '__main__': basebot.run_main(TellBot, mgrcls=TellBotManager)